@@ -0,0 +1,384 @@
+"""Benchmarks for gitignore_parser.
+
+Run the benchmark suite with:
+
+    python benchmark.py [--json results.json]
+
+The suite parses synthetic small, medium and monorepo-scale .gitignore
+files and matches deep, wide and Windows-style path workloads against
+them. It reports parse time, per-path latency percentiles, throughput and
+peak memory. With --json, the results are also written in a machine
+readable form, to compare releases.
+
+    python benchmark.py --comparisons
+
+runs the before/after comparisons of individual optimizations instead.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tracemalloc
+from tempfile import TemporaryDirectory
+from time import perf_counter, perf_counter_ns
+from timeit import timeit
+
+import gitignore_parser
+from gitignore_parser import handle_negation, parse_gitignore_str
+
+BASE_DIR = '/home/michael/project'
+
+
+def synthetic_gitignore(num_rules):
+    """A .gitignore with a mix of names, extensions, anchored paths and
+    negations, as found in large monorepos."""
+    lines = []
+    for i in range(num_rules):
+        kind = i % 5
+        if kind == 0:
+            lines.append('*.ext%d' % i)
+        elif kind == 1:
+            lines.append('generated_%d/' % i)
+        elif kind == 2:
+            lines.append('/tools/component_%d/out' % i)
+        elif kind == 3:
+            lines.append('**/cache_%d/**/*.bin' % i)
+        else:
+            lines.append('!keep_%d.ext%d' % (i, i - 4))
+    return '\n'.join(lines)
+
+
+def synthetic_paths(num_paths):
+    return [
+        '%s/src/module_%d/sub_%d/file_%d.ext%d'
+        % (BASE_DIR, i % 17, i % 5, i, i % 400)
+        for i in range(num_paths)
+    ]
+
+
+def bench_rule_set(num_rules=300, num_paths=2000):
+    matches = parse_gitignore_str(synthetic_gitignore(num_rules), BASE_DIR)
+    rules = matches.rules
+    per_rule = lambda file_path: handle_negation(file_path, rules)
+    paths = synthetic_paths(num_paths)
+    assert [per_rule(p) for p in paths] == [matches(p) for p in paths]
+    before = timeit(lambda: [per_rule(p) for p in paths], number=1)
+    after = timeit(lambda: [matches(p) for p in paths], number=1)
+    print('%d rules, %d paths:' % (num_rules, num_paths))
+    print('  per-rule re.search: %8.1f us/path' % (before / num_paths * 1e6))
+    print('  combined regex:     %8.1f us/path' % (after / num_paths * 1e6))
+    print('  speedup:            %8.1fx' % (before / after))
+
+
+def bench_match_many(num_rules=50, num_paths=20000):
+    matches = parse_gitignore_str(synthetic_gitignore(num_rules), BASE_DIR)
+    paths = synthetic_paths(num_paths)
+    one_by_one = timeit(lambda: [matches(p) for p in paths], number=1)
+    batch = timeit(lambda: list(matches.match_many(paths)), number=1)
+    print('%d rules, %d paths:' % (num_rules, num_paths))
+    print('  one call per path:  %8.1f us/path' % (one_by_one / num_paths * 1e6))
+    print('  match_many:         %8.1f us/path' % (batch / num_paths * 1e6))
+
+
+def synthetic_tree(root, num_dirs=100, files_per_dir=50):
+    """Create directories with source files, build outputs and
+    node_modules below root."""
+    for i in range(num_dirs):
+        for sub in ('src', 'src/pkg', 'build', 'node_modules/dep'):
+            directory = os.path.join(root, 'dir_%d' % i, sub)
+            os.makedirs(directory)
+            for j in range(files_per_dir // 4):
+                ext = ('py', 'pyc', 'ext%d' % j, 'o')[j % 4]
+                open(os.path.join(directory, 'f%d.%s' % (j, ext)), 'w').close()
+
+
+def bench_scan(max_workers=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    with TemporaryDirectory() as root:
+        synthetic_tree(root)
+        gitignore = synthetic_gitignore(100) + '\nbuild/\nnode_modules/\n'
+        matches = parse_gitignore_str(gitignore, root)
+        print('scan of %s:' % root)
+        for processes in (False, True):
+            workers = 1
+            while workers <= max_workers:
+                duration = timeit(
+                    lambda: list(matches.scan(root, workers, processes)),
+                    number=1
+                )
+                print('  %d %s: %8.1f ms' % (
+                    workers, 'processes' if processes else 'threads  ',
+                    duration * 1e3
+                ))
+                workers *= 2
+
+
+def bench_compiled_rules(num_rule_sets=60, num_rules=100, num_calls=100000):
+    """Per-call latency of a rule's regex with more distinct regexes loaded
+    than fit into the re module's cache, and into the LRU cache used for
+    rules created directly."""
+    rules = []
+    for i in range(num_rule_sets):
+        gitignore = synthetic_gitignore(num_rules).replace('_', '_%d_' % i)
+        rules.extend(parse_gitignore_str(gitignore, BASE_DIR).rules)
+    num_regexes = len(set(rule.regex for rule in rules))
+    assert num_regexes > gitignore_parser._REGEX_CACHE_SIZE
+    rel_path = 'src/module_1/sub_1/file_1.ext1'
+    calls = [rules[i % len(rules)] for i in range(num_calls)]
+    plain_regexes = [str(rule.regex) for rule in calls]
+    before = timeit(
+        lambda: [re.search(rule.regex, rel_path) for rule in calls], number=1
+    )
+    lru = timeit(
+        lambda: [gitignore_parser._compile_regex(regex).search(rel_path)
+                 for regex in plain_regexes], number=1
+    )
+    after = timeit(
+        lambda: [rule.compiled.search(rel_path) for rule in calls], number=1
+    )
+    print('%d distinct regexes:' % num_regexes)
+    print('  re.search(regex):   %8.2f us/call' % (before / num_calls * 1e6))
+    print('  LRU cache:          %8.2f us/call' % (lru / num_calls * 1e6))
+    print('  compiled.search:    %8.2f us/call' % (after / num_calls * 1e6))
+
+
+def bench_startup(num_files=30, num_rules=200, runs=5):
+    """Time fresh processes parsing num_files .gitignore files, with and
+    without the rule cache."""
+    with TemporaryDirectory() as root:
+        paths = []
+        for i in range(num_files):
+            path = os.path.join(root, '%d.gitignore' % i)
+            with open(path, 'w') as gitignore:
+                gitignore.write(synthetic_gitignore(num_rules).replace(
+                    '_', '_%d_' % i
+                ))
+            paths.append(path)
+        cache_dir = os.path.join(root, 'cache')
+        script = (
+            'import sys; from gitignore_parser import parse_gitignore\n'
+            'cache_dir = sys.argv[1] or None\n'
+            'for path in sys.argv[2:]:\n'
+            '    parse_gitignore(path, cache_dir=cache_dir)\n'
+        )
+        here = os.path.dirname(os.path.abspath(__file__))
+        def run(cache_dir, paths=paths):
+            subprocess.run(
+                [sys.executable, '-c', script, cache_dir] + paths,
+                check=True, cwd=here
+            )
+        run(cache_dir)
+        import_only = timeit(lambda: run('', []), number=runs) / runs
+        without = timeit(lambda: run(''), number=runs) / runs
+        with_cache = timeit(lambda: run(cache_dir), number=runs) / runs
+        print('startup parsing %d files of %d rules:' % (num_files, num_rules))
+        print('  import only:        %8.1f ms' % (import_only * 1e3))
+        print('  without cache:      %8.1f ms' % (without * 1e3))
+        print('  with cache:         %8.1f ms' % (with_cache * 1e3))
+
+
+def bench_memory(num_files=10000, rules_per_file=20):
+    """Memory held by rule sets for num_files .gitignore files of different
+    repositories, which draw their patterns from a shared pool."""
+    pool = synthetic_gitignore(200).splitlines()
+    gitignores = [
+        '\n'.join(pool[(i * 7 + j * 13) % len(pool)]
+                  for j in range(rules_per_file))
+        for i in range(num_files)
+    ]
+    tracemalloc.start()
+    rule_sets = [
+        parse_gitignore_str(gitignore, '/srv/repos/repo_%d' % i)
+        for i, gitignore in enumerate(gitignores)
+    ]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    num_rules = sum(len(rule_set) for rule_set in rule_sets)
+    print('%d rule sets with %d rules:' % (len(rule_sets), num_rules))
+    print('  retained:           %8.1f MB' % (current / 1e6))
+    print('  peak:               %8.1f MB' % (peak / 1e6))
+    print('  per rule:           %8.1f bytes' % (current / num_rules))
+
+
+# The number of rules of the corpora in the suite.
+CORPORA = {'small': 20, 'medium': 300, 'monorepo': 3000}
+
+
+def synthetic_corpus(num_rules, seed=0):
+    """A deterministic .gitignore with num_rules rules. About a quarter of
+    the rules are negations and many use **, as in monorepos that
+    re-include generated files or vendored code."""
+    rnd = random.Random(seed)
+    names = ['build', 'dist', 'out', 'node_modules', 'target', 'vendor',
+             'generated', 'cache', 'tmp', 'logs', 'coverage', '.venv']
+    exts = ['pyc', 'o', 'so', 'log', 'tmp', 'class', 'jar', 'swp', 'bak']
+    lines = ['# Synthetic .gitignore with %d rules' % num_rules]
+    for i in range(num_rules):
+        name = '%s_%d' % (rnd.choice(names), i)
+        ext = '%s%d' % (rnd.choice(exts), i % 50)
+        line = rnd.choice([
+            '%s/' % name,
+            '*.%s' % ext,
+            '/%s/%s' % (rnd.choice(names), name),
+            '**/%s/**/*.%s' % (name, ext),
+            '%s/**/%s' % (name, rnd.choice(names)),
+            'src/**/%s_[0-9]*.%s' % (name, ext),
+            '%s?.%s' % (name, ext),
+        ])
+        if rnd.random() < 0.25:
+            line = '!' + line
+        lines.append(line)
+        if rnd.random() < 0.05:
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def workload_paths(workload, num_paths, seed=0):
+    """Paths below BASE_DIR for the given workload:
+    deep: 10-30 levels of nested directories.
+    wide: many files in a few directories.
+    windows: Windows-style names with backslashes, mixed case and
+        trailing dots and spaces. On Windows, the backslashes are path
+        separators."""
+    rnd = random.Random(seed)
+    names = ['src', 'lib', 'build', 'node_modules', 'vendor', 'cache_3',
+             'generated_7', 'pkg', 'internal', 'target_12', 'dist_40']
+    exts = ['py', 'pyc', 'o', 'log', 'txt', 'class', 'so0', 'log9', 'tmp3']
+    paths = []
+    for i in range(num_paths):
+        if workload == 'deep':
+            parts = [rnd.choice(names) for _ in range(rnd.randint(10, 30))]
+        elif workload == 'wide':
+            parts = ['wide_%d' % rnd.randint(0, 3)]
+        else:
+            parts = [rnd.choice(names).title()
+                     for _ in range(rnd.randint(2, 8))]
+        # Distinct seeds give distinct file names.
+        filename = 'file_%d.%s' % (seed * num_paths + i, rnd.choice(exts))
+        if workload == 'windows':
+            filename = filename.upper() + rnd.choice(['', '.', ' '])
+            paths.append(BASE_DIR + '/' + '\\'.join(parts + [filename]))
+        else:
+            paths.append('/'.join([BASE_DIR] + parts + [filename]))
+    return paths
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_suite(num_paths=500, repeat=2, engine='regex'):
+    """Run every corpus against every workload. Return a list of result
+    dicts. Every measurement uses paths with file names the matcher hasn't
+    seen yet, as the automaton engine caches what it learns from paths."""
+    results = []
+    for corpus, num_rules in CORPORA.items():
+        gitignore = synthetic_corpus(num_rules)
+        # Parse and compile from scratch, as a fresh process would.
+        gitignore_parser._translations.clear()
+        tracemalloc.start()
+        start = perf_counter()
+        matches = parse_gitignore_str(gitignore, BASE_DIR, engine=engine)
+        parse_time = perf_counter() - start
+        matches(BASE_DIR + '/src/main.py')
+        compile_time = perf_counter() - start - parse_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        for workload in ('deep', 'wide', 'windows'):
+            paths = workload_paths(workload, num_paths)
+            latencies = []
+            for path in paths:
+                start = perf_counter_ns()
+                matches(path)
+                latencies.append(perf_counter_ns() - start)
+            latencies.sort()
+            throughput = max(
+                num_paths / timeit(
+                    lambda: list(matches.match_many(
+                        workload_paths(workload, num_paths, seed)
+                    )), number=1
+                )
+                for seed in range(1, repeat + 1)
+            )
+            results.append({
+                'engine': engine,
+                'corpus': corpus,
+                'rules': len(matches),
+                'workload': workload,
+                'paths': num_paths,
+                'parse_ms': parse_time * 1e3,
+                'compile_ms': compile_time * 1e3,
+                'peak_memory_kb': peak / 1e3,
+                'latency_us': {
+                    'p50': percentile(latencies, 0.5) / 1e3,
+                    'p90': percentile(latencies, 0.9) / 1e3,
+                    'p99': percentile(latencies, 0.99) / 1e3,
+                    'max': latencies[-1] / 1e3,
+                },
+                'match_many_paths_per_s': throughput,
+            })
+    return results
+
+
+def print_results(results):
+    print('%-9s %5s %-8s %9s %9s %9s %8s %8s %8s %11s' % (
+        'corpus', 'rules', 'workload', 'parse ms', 'compile', 'peak kB',
+        'p50 us', 'p90 us', 'p99 us', 'paths/s'
+    ))
+    for r in results:
+        print('%-9s %5d %-8s %9.2f %9.2f %9.1f %8.1f %8.1f %8.1f %11.0f' % (
+            r['corpus'], r['rules'], r['workload'], r['parse_ms'],
+            r['compile_ms'], r['peak_memory_kb'], r['latency_us']['p50'],
+            r['latency_us']['p90'], r['latency_us']['p99'],
+            r['match_many_paths_per_s']
+        ))
+
+
+def run_comparisons():
+    bench_rule_set()
+    bench_match_many()
+    bench_scan()
+    bench_compiled_rules()
+    bench_startup()
+    bench_memory()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE, or - for stdout')
+    parser.add_argument('--paths', type=int, default=500,
+                        help='the number of paths per workload')
+    parser.add_argument('--engine', default='regex',
+                        choices=['regex', 'automaton'],
+                        help='the matching engine to benchmark')
+    parser.add_argument('--comparisons', action='store_true',
+                        help='run the before/after comparisons instead')
+    args = parser.parse_args()
+    if args.comparisons:
+        run_comparisons()
+        return
+    results = run_suite(args.paths, engine=args.engine)
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        return
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
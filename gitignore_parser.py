@@ -1,10 +1,20 @@
+import asyncio
 import collections
+import functools
+import hashlib
+import io
+import marshal
 import os
 import re
+import threading
+import weakref
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
 from os.path import abspath, dirname, join
 from pathlib import Path
 import sys
+from time import perf_counter
 from typing import Reversible, Union
 
 def handle_negation(file_path, rules: Reversible["IgnoreRule"]):
@@ -13,31 +23,172 @@ def handle_negation(file_path, rules: Reversible["IgnoreRule"]):
             return not rule.negation
     return False
 
-def parse_gitignore(full_path, base_dir=None):
+def parse_gitignore(full_path, base_dir=None, cache_dir=None, **kwargs):
+    """
+    Parse the .gitignore file at full_path into an IgnoreRuleSet. Further
+    keyword arguments, such as cache_size, are passed to IgnoreRuleSet.
+    With cache_dir, the parsed rules are stored in that directory, and
+    reused by later processes for as long as the file's modification time,
+    size and inode stay the same.
+    """
     if base_dir is None:
         base_dir = dirname(full_path)
+    if cache_dir is not None:
+        return _parse_gitignore_cached(full_path, base_dir, cache_dir, **kwargs)
     with open(full_path) as ignore_file:
-        return _parse_gitignore_lines(ignore_file, full_path, base_dir)
+        return _parse_gitignore_lines(ignore_file, full_path, base_dir, **kwargs)
 
-def parse_gitignore_str(gitignore_str, base_dir):
+def parse_gitignore_str(gitignore_str, base_dir, **kwargs):
     full_path = join(base_dir, '.gitignore')
     lines = gitignore_str.splitlines()
-    return _parse_gitignore_lines(lines, full_path, base_dir)
+    return _parse_gitignore_lines(lines, full_path, base_dir, **kwargs)
 
-def _parse_gitignore_lines(lines, full_path, base_dir):
-    base_dir = _normalize_path(base_dir)
-    rules = []
+def parse_gitignore_lines(lines, base_dir, full_path=None, on_error=None,
+                          on_progress=None, **kwargs):
+    """
+    Parse .gitignore lines from any source into an IgnoreRuleSet. See
+    iter_gitignore_rules for the arguments. Further keyword arguments are
+    passed to IgnoreRuleSet.
+    """
+    rules = iter_gitignore_rules(
+        lines, base_dir, full_path, on_error, on_progress
+    )
+    return IgnoreRuleSet(rules, **kwargs)
+
+def iter_gitignore_rules(lines, base_dir, full_path=None, on_error=None,
+                         on_progress=None):
+    """
+    Lazily parse .gitignore lines into IgnoreRules, without holding on to
+    the text. lines can be a file object in text or binary mode, such as
+    sys.stdin, any iterable of str or bytes lines, or a whole str or bytes.
+    bytes are decoded as UTF-8, with undecodable bytes kept like
+    os.fsdecode does. full_path is the file name for the rules' source and
+    defaults to base_dir/.gitignore.
+    If a line can't be parsed, on_error(source, line, exception) is called
+    with the (full_path, line_no) source of the line, and the line is
+    skipped. Without on_error, the exception is raised.
+    on_progress(line_no, num_rules) is called every 10000 lines and when
+    done.
+    """
+    if full_path is None:
+        full_path = join(base_dir, '.gitignore')
+    if isinstance(lines, str):
+        lines = io.StringIO(lines)
+    elif isinstance(lines, (bytes, bytearray)):
+        lines = io.BytesIO(lines)
+    base_dir = _intern_path(_normalize_path(base_dir))
+    line_no = num_rules = 0
     for line_no, line in enumerate(lines, start=1):
-        rule = rule_from_pattern(
-            line.rstrip('\n'), base_path=base_dir, source=(full_path, line_no))
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'surrogateescape')
+        line = line.rstrip('\n')
+        if line[-1:] == '\r':
+            line = line[:-1]
+        source = (full_path, line_no)
+        try:
+            rule = rule_from_pattern(line, base_path=base_dir, source=source)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(source, line, e)
+            continue
         if rule:
-            rules.append(rule)
-    if not any(r.negation for r in rules):
-        return lambda file_path: any(r.match(file_path) for r in rules)
-    else:
-        # We have negation rules. We can't use a simple "any" to evaluate them.
-        # Later rules override earlier rules.
-        return lambda file_path: handle_negation(file_path, rules)
+            num_rules += 1
+            yield rule
+        if on_progress is not None and line_no % _PROGRESS_INTERVAL == 0:
+            on_progress(line_no, num_rules)
+    if on_progress is not None:
+        on_progress(line_no, num_rules)
+
+# The number of lines between calls of iter_gitignore_rules' on_progress.
+_PROGRESS_INTERVAL = 10000
+
+def _parse_gitignore_lines(lines, full_path, base_dir, **kwargs):
+    return parse_gitignore_lines(lines, base_dir, full_path, **kwargs)
+
+def _parse_gitignore_cached(full_path, base_dir, cache_dir, **kwargs):
+    stat = os.stat(full_path)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    base_dir = _intern_path(_normalize_path(base_dir))
+    key = '%s\0%s' % (abspath(full_path), base_dir)
+    cache_path = join(
+        cache_dir,
+        hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+    )
+    rules = _load_cached_rules(cache_path, signature, full_path, base_dir)
+    if rules is not None:
+        return IgnoreRuleSet(rules, **kwargs)
+    rule_set = parse_gitignore(full_path, base_dir, **kwargs)
+    _store_cached_rules(cache_path, signature, rule_set.rules)
+    return rule_set
+
+
+# Bump this when the format of the rule cache, or the translation of
+# patterns, changes.
+_RULE_CACHE_VERSION = 1
+
+
+def _load_cached_rules(cache_path, signature, full_path, base_dir):
+    """
+    Return the rules stored for the given file signature, or None. Loading
+    them does not translate any patterns.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            header, records = marshal.load(cache_file)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if header != (_RULE_CACHE_VERSION, sys.version_info[:2], signature):
+        return None
+    rules = []
+    for line_no, pattern, translation in records:
+        pattern = sys.intern(pattern)
+        regex, negation, directory_only, anchored, kind, literal = translation
+        regex = _Regex(regex)
+        if len(_translations) >= _TRANSLATION_CACHE_SIZE:
+            _translations.clear()
+        _translations[pattern] = \
+            (regex, negation, directory_only, anchored, kind, literal)
+        rules.append(IgnoreRule(
+            pattern=pattern,
+            regex=regex,
+            negation=negation,
+            directory_only=directory_only,
+            anchored=anchored,
+            base_path=base_dir,
+            source=(full_path, line_no)
+        ))
+    return rules
+
+
+def _store_cached_rules(cache_path, signature, rules):
+    """
+    Store the rules in the compact binary marshal format. Errors are
+    ignored; the cache is only an optimization.
+    """
+    header = (_RULE_CACHE_VERSION, sys.version_info[:2], signature)
+    records = []
+    for rule in rules:
+        translation = _translate_pattern(rule.pattern)
+        # marshal only stores plain strs.
+        translation = (str(translation[0]),) + translation[1:]
+        records.append((rule.source[1], rule.pattern, translation))
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        os.makedirs(dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'wb') as cache_file:
+            marshal.dump((header, records), cache_file)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+# The number of distinct patterns whose translation is cached.
+_TRANSLATION_CACHE_SIZE = 4096
+
 
 def rule_from_pattern(pattern, base_path=None, source=None):
     """
@@ -48,8 +199,76 @@ def rule_from_pattern(pattern, base_path=None, source=None):
     Because git allows for nested .gitignore files, a base_path value
     is required for correct behavior. The base path should be absolute.
     """
-    # Store the exact pattern for our repr and string functions
-    orig_pattern = pattern
+    translation = _translate_pattern(pattern)
+    if translation is None:
+        return
+    regex, negation, directory_only, anchored, _, _ = translation
+    return IgnoreRule(
+        # Store the exact pattern for our repr and string functions. Many
+        # rule sets share patterns, so share their strings too.
+        pattern=sys.intern(pattern),
+        regex=regex,
+        negation=negation,
+        directory_only=directory_only,
+        anchored=anchored,
+        base_path=base_path if base_path else None,
+        source=source
+    )
+
+
+# The kinds of patterns which IgnoreRuleSet looks up in dicts instead of
+# matching their regex:
+_NAME = 'name'  # "foo": The last path component is foo.
+_COMPONENT = 'component'  # "foo/": Any path component is foo.
+_SUFFIX = 'suffix'  # "*.ext": The last path component ends with .ext.
+_PATH = 'path'  # "/foo/bar": The path is foo/bar.
+_PREFIX = 'prefix'  # "/foo/bar/": The path is or starts with foo/bar/.
+
+
+# Translations of recently seen patterns by _translate_pattern. Many
+# .gitignore files share patterns. The rule cache of parse_gitignore also
+# adds the translations it loads here.
+_translations = {}
+
+
+def _translate_pattern(pattern):
+    """
+    The work behind rule_from_pattern: Return the tuple (regex, negation,
+    directory_only, anchored, kind, literal) for the given pattern, or None
+    if it does not match any files. kind is one of the literal pattern kinds
+    above, with literal the string to look up, or None for patterns which
+    need their regex.
+    """
+    try:
+        return _translations[pattern]
+    except KeyError:
+        pass
+    if len(_translations) >= _TRANSLATION_CACHE_SIZE:
+        _translations.clear()
+    translation = _translations[pattern] = _translate_pattern_uncached(pattern)
+    return translation
+
+
+def _translate_pattern_uncached(pattern):
+    parsed = _parse_pattern(pattern)
+    if parsed is None:
+        return
+    pattern, negation, directory_only, anchored = parsed
+    regex = fnmatch_pathname_to_regex(
+        pattern, directory_only, negation, anchored=bool(anchored)
+    )
+    kind, literal = _classify_pattern(
+        pattern, negation, directory_only, anchored
+    )
+    return _Regex(regex), negation, directory_only, anchored, kind, literal
+
+
+def _parse_pattern(pattern):
+    """
+    Return (pattern, negation, directory_only, anchored) for a .gitignore
+    pattern, with the pattern stripped of the characters the flags stand
+    for, or None if it does not match any files.
+    """
     # Early returns follow
     # Discard comments and separators
     if pattern.strip() == '' or pattern[0] == '#':
@@ -98,18 +317,122 @@ def rule_from_pattern(pattern, base_path=None, source=None):
             if striptrailingspaces:
                 pattern = pattern[:i]
         i = i - 1
-    regex = fnmatch_pathname_to_regex(
-        pattern, directory_only, negation, anchored=bool(anchored)
-    )
-    return IgnoreRule(
-        pattern=orig_pattern,
-        regex=regex,
-        negation=negation,
-        directory_only=directory_only,
-        anchored=anchored,
-        base_path=base_path if base_path else None,
-        source=source
-    )
+    return pattern, negation, directory_only, anchored
+
+
+def _classify_pattern(pattern, negation, directory_only, anchored):
+    """Return (kind, literal) for a pattern processed by _translate_pattern."""
+    if negation and directory_only:
+        # These only match paths with a trailing slash.
+        return None, None
+    if not any(c in pattern for c in '*?['):
+        if anchored:
+            return (_PREFIX if directory_only else _PATH), pattern
+        if '/' not in pattern:
+            return (_COMPONENT if directory_only else _NAME), pattern
+    elif not directory_only and not anchored and pattern[:2] == '*.':
+        extension = pattern[2:]
+        if extension and not any(c in extension for c in '*?[./'):
+            return _SUFFIX, extension
+    return None, None
+
+
+def optimize_rules(rules, stats=None):
+    """
+    Return a list of the given IgnoreRules which decides every path the same
+    way, with fewer rules and in a faster order:
+    - Rules which a later rule with the same base path and negation always
+      overrides are removed. These are duplicates, and literal patterns
+      covered by later literal patterns, such as "build/main.pyc" before
+      "*.pyc", or "/docs/build/" before "build/".
+    - Negations before the first remaining non-negated rule are removed, as
+      they can only decide paths which would not be ignored anyway. So
+      don't optimize rule sets which are combined with others, as the
+      .gitignore files in a parse_gitignore_tree are.
+    - If no negations remain, the order of the rules doesn't matter. Rules
+      are evaluated from the last to the first, and the first match
+      decides, so the rules with the most hits go last, and with equal hits,
+      the cheaper ones. stats is a list of RuleStats, as returned by
+      rule_stats() of a profiling IgnoreRuleSet; without it, rules are only
+      ordered by cost.
+    The rules reported by check() may differ.
+    """
+    rules = list(rules)
+    kept = []
+    covering = collections.defaultdict(_CoveringRules)
+    for rule in reversed(rules):
+        kind, literal = _literal_kind(rule)
+        covering_rules = covering[rule.base_path, rule.negation]
+        if not covering_rules.covers(rule.regex, kind, literal):
+            kept.append(rule)
+            covering_rules.add(rule.regex, kind, literal)
+    kept.reverse()
+    while kept and kept[0].negation:
+        del kept[0]
+    if any(rule.negation for rule in kept):
+        return kept
+    hits = collections.Counter()
+    for rule_stats in stats or ():
+        hits[rule_stats.rule] += rule_stats.hits
+    return sorted(kept, key=lambda rule: (hits[rule], -_rule_cost(rule)))
+
+
+class _CoveringRules:
+    """
+    The regexes and literals of rules with the same base path and negation,
+    to find rules which one of them always overrides.
+    """
+    def __init__(self):
+        self.regexes = set()
+        self.names = set()
+        self.components = set()
+        self.suffixes = set()
+        # The parts of _PREFIX literals, as tuples.
+        self.prefixes = set()
+
+    def add(self, regex, kind, literal):
+        self.regexes.add(regex)
+        if kind == _NAME:
+            self.names.add(literal)
+        elif kind == _COMPONENT:
+            self.components.add(literal)
+        elif kind == _SUFFIX:
+            self.suffixes.add(literal)
+        elif kind == _PREFIX:
+            self.prefixes.add(tuple(literal.split('/')))
+
+    def covers(self, regex, kind, literal):
+        """Whether any path matching regex also matches one of the rules."""
+        if regex in self.regexes:
+            return True
+        if kind is None:
+            return False
+        if kind == _SUFFIX:
+            return literal in self.suffixes
+        parts = literal.split('/')
+        if any(part in self.components for part in parts):
+            return True
+        if kind in (_PATH, _PREFIX):
+            if any(tuple(parts[:i]) in self.prefixes
+                   for i in range(1, len(parts) + 1)):
+                return True
+        if kind in (_NAME, _PATH):
+            basename = parts[-1]
+            _, dot, extension = basename.rpartition('.')
+            return basename in self.names or \
+                bool(dot) and extension in self.suffixes
+        return False
+
+
+def _rule_cost(rule):
+    """A rough estimate of the cost of matching the rule."""
+    if _literal_kind(rule)[0] is not None:
+        # A dict lookup.
+        return 0
+    cost = 1 + rule.regex.count('*')
+    if rule.regex[0] != '^':
+        cost += 1
+    return cost
 
 
 IGNORE_RULE_FIELDS = [
@@ -121,33 +444,1908 @@ IGNORE_RULE_FIELDS = [
 
 
 class IgnoreRule(collections.namedtuple('IgnoreRule_', IGNORE_RULE_FIELDS)):
+    # No per-instance __dict__: large rule sets hold many rules.
+    __slots__ = ()
+
     def __str__(self):
         return self.pattern
 
     def __repr__(self):
         return ''.join(['IgnoreRule(\'', self.pattern, '\')'])
 
+    @property
+    def compiled(self) -> re.Pattern:
+        """
+        The compiled regex. Rules created from patterns carry it, once it
+        is compiled, and share it with the other rules with the same
+        pattern, so it lives as long as they do and is never evicted like
+        from re's cache. For rules created directly, compiled regexes are
+        kept in an LRU cache of _REGEX_CACHE_SIZE entries.
+        """
+        return _rule_pattern(self.regex)
+
     def match(self, abs_path: Union[str, Path]):
         matched = False
-        if self.base_path:
-            rel_path = _normalize_path(abs_path).relative_to(self.base_path).as_posix()
-        else:
-            rel_path = _normalize_path(abs_path).as_posix()
-        # Path() strips the trailing following symbols on windows, so we need to
-        # preserve it: ' ', '.'
-        if sys.platform.startswith('win'):
-            rel_path += ' ' * _count_trailing_symbol(' ', abs_path)
-            rel_path += '.' * _count_trailing_symbol('.', abs_path)
+        rel_path = _relative_path(abs_path, self.base_path)
         # Path() strips the trailing slash, so we need to preserve it
         # in case of directory-only negation
-        if self.negation and type(abs_path) == str and abs_path[-1] == '/':
+        if self.negation and self.directory_only and \
+                type(abs_path) == str and abs_path[-1] == '/':
             rel_path += '/'
-        if rel_path.startswith('./'):
-            rel_path = rel_path[2:]
-        if re.search(self.regex, rel_path):
+        if self._search(rel_path):
             matched = True
         return matched
 
+    def _search(self, rel_path):
+        return _search_method(self.regex)(rel_path)
+
+
+class _Regex(str):
+    """
+    The regex of rules created from a pattern, which keeps its compiled
+    pattern once it is compiled.
+    """
+    def __reduce__(self):
+        # Pickle without the compiled pattern.
+        return _Regex, (str(self),)
+
+
+def _rule_pattern(regex):
+    """Return the compiled pattern of a rule's regex."""
+    compiled = getattr(regex, 'compiled', None)
+    if compiled is None:
+        if type(regex) is _Regex:
+            compiled = regex.compiled = re.compile(regex)
+        else:
+            compiled = _compile_regex(regex)
+    return compiled
+
+
+# Bounded, so that a long-running process which parses the ignore files of
+# many repositories doesn't keep every regex it has seen.
+_REGEX_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=_REGEX_CACHE_SIZE)
+def _compile_regex(regex):
+    return re.compile(regex)
+
+
+def _search_method(regex):
+    compiled = _rule_pattern(regex)
+    # Anchored regexes can only match at the start.
+    if regex[0] == '^':
+        return compiled.match
+    return compiled.search
+
+
+class _Matcher:
+    """
+    Batch matching and directory traversal for the callable matchers
+    below, in terms of their __call__ and check.
+    """
+    def check_many(self, paths):
+        """Lazily yield a CheckResult for each of paths, in order."""
+        for path in paths:
+            yield self.check(path)
+
+    def match_many(self, paths):
+        """
+        Yield whether each of paths is ignored, in order. paths can be any
+        iterable, including a generator; it is consumed lazily. Use eg.
+        bytearray(matches.match_many(paths)) for a compact bitmap.
+        """
+        for _, ignored in self._match_pairs(paths):
+            yield ignored
+
+    def filter(self, paths, ignored=False):
+        """
+        Lazily yield those of paths which are not ignored. Pass ignored=True
+        to get the ignored paths instead.
+        """
+        for path, is_ignored in self._match_pairs(paths):
+            if is_ignored == ignored:
+                yield path
+
+    def walk(self, root):
+        """
+        Like os.walk(root), but leaves out ignored files and directories.
+        Ignored directories are not descended into; as in git, files below
+        an excluded directory cannot be re-included. Symbolic links are
+        listed as files and never followed. As with os.walk, removing
+        entries from the yielded dirnames prunes them from the traversal.
+        """
+        stack = [os.fspath(root)]
+        while stack:
+            top = stack.pop()
+            dirnames, filenames = self._scan_dir(top)
+            yield top, dirnames, filenames
+            stack.extend(join(top, name) for name in reversed(dirnames))
+
+    def scan(self, root, workers=None, processes=False, ordered=False):
+        """
+        Yield the paths of the files below root which are not ignored, like
+        walk, but traverse subtrees in parallel on a thread pool, or process
+        pool if processes=True, with the given number of workers. Workers
+        get a copy of this matcher. Each subtree's paths are yielded as soon
+        as it is done, or in a deterministic order if ordered=True.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        # Split the tree into enough subtrees to keep all workers busy.
+        subtrees = [os.fspath(root)]
+        for _ in range(_SCAN_SPLIT_DEPTH):
+            if len(subtrees) >= _SCAN_SUBTREES_PER_WORKER * workers:
+                break
+            next_level = []
+            for top in subtrees:
+                dirnames, filenames = self._scan_dir(top)
+                for name in filenames:
+                    yield join(top, name)
+                next_level.extend(join(top, name) for name in dirnames)
+            subtrees = next_level
+        if processes:
+            executor = ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(self,)
+            )
+            matcher = None
+        else:
+            executor = ThreadPoolExecutor(workers)
+            matcher = self
+        with executor:
+            futures = [
+                executor.submit(_scan_subtree, matcher, top) for top in subtrees
+            ]
+            try:
+                for future in futures if ordered else as_completed(futures):
+                    yield from future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    async def aiter_unignored(self, root, executor=None, max_pending=4):
+        """
+        Asynchronously yield the paths of the files below root which are not
+        ignored, like walk. Listing and matching each directory runs in the
+        given executor, by default the event loop's, so the event loop is
+        never blocked. At most max_pending directories are listed ahead of
+        the consumer. Cancelling, or closing the generator, cancels the
+        directories not started yet.
+        """
+        loop = asyncio.get_running_loop()
+        todo = [os.fspath(root)]
+        pending = collections.deque()
+        try:
+            while todo or pending:
+                while todo and len(pending) < max_pending:
+                    top = todo.pop()
+                    pending.append((top, loop.run_in_executor(
+                        executor, self._scan_dir, top
+                    )))
+                top, future = pending.popleft()
+                dirnames, filenames = await future
+                todo.extend(join(top, name) for name in reversed(dirnames))
+                for name in filenames:
+                    yield join(top, name)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    async def afilter(self, paths, ignored=False, chunk_size=1000,
+                      executor=None):
+        """
+        Asynchronously yield those of paths which are not ignored, or the
+        ignored ones if ignored=True. paths can be an iterable or an async
+        iterable. They are matched in chunks of chunk_size paths in the
+        given executor, by default the event loop's.
+        """
+        loop = asyncio.get_running_loop()
+        filter_chunk = lambda chunk: list(self.filter(chunk, ignored))
+        async for chunk in _achunks(paths, chunk_size):
+            for path in await loop.run_in_executor(
+                    executor, filter_chunk, chunk):
+                yield path
+
+    def _scan_dir(self, top):
+        """Return the names of the unignored dirs and files in top."""
+        try:
+            with os.scandir(top) as it:
+                entries = list(it)
+        except OSError:
+            return [], []
+        # Directory entries are queried as directories, so that
+        # directory-only negations such as "!data/**/" apply to them, as
+        # well as negations such as "!build".
+        dirnames, filenames = [], []
+        for entry, ignored in zip(entries, self.match_many(entries)):
+            if not ignored:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                (dirnames if is_dir else filenames).append(entry.name)
+        return dirnames, filenames
+
+    def _match_pairs(self, paths):
+        for path in paths:
+            yield path, self(path)
+
+
+class IgnoreRuleSet(_Matcher):
+    """
+    A callable matcher for a list of IgnoreRules, as returned by
+    parse_gitignore. Calling it with a path returns True if the path is
+    ignored.
+    Instead of searching every rule's regex in turn, literal patterns are
+    looked up in dicts and the other rules are compiled into a few
+    alternations per base path. The last matching rule decides, as in git.
+    With cache_size > 0, the results for the last cache_size paths queried
+    are cached. Because the cache is keyed by the path as given, relative
+    paths are resolved against the working directory of their first query.
+    With exclude_below_excluded_dirs=True, a path is also ignored when one
+    of its parent directories below the base path is, as in git, so that
+    "build" followed by "!build/keep" still ignores build/keep. The
+    verdicts for those directories are cached, so once build/ is known to
+    be excluded, anything below it is answered without evaluating rules.
+    This only applies to rules which share one base path; for others, such
+    as rules combined from nested .gitignore files, the option silently
+    does nothing. Use parse_gitignore_tree for those.
+    With profile=True, each rule's evaluations, hits and evaluation time are
+    counted, for rule_stats(). Rules are then evaluated one by one, from the
+    last to the first, so this is much slower. on_rule_hit, which implies
+    profile, is called with (rule, rel_path, seconds) whenever a rule
+    decides about a path relative to its base path, with the time it took.
+    engine selects how rules are matched: 'regex', the default_engine, or
+    'automaton', which compiles the rules into an automaton over path
+    components. Its matching time grows with the path's depth and the
+    number of rules a path could match, but hardly with the number of
+    rules, which suits large rule sets with many "**". Rules it can't
+    express, such as "a[!b]c", are matched like by the regex engine.
+    Assigning to the rules attribute recompiles the rules and clears the
+    caches and statistics.
+    """
+    default_engine = 'regex'
+
+    def __init__(self, rules, cache_size=0, exclude_below_excluded_dirs=False,
+                 profile=False, on_rule_hit=None, engine=None):
+        if engine is None:
+            engine = self.default_engine
+        if engine not in _ENGINES:
+            raise ValueError('Unknown engine %r' % engine)
+        self._engine = engine
+        self._cache_size = cache_size
+        self._exclude_below_excluded_dirs = exclude_below_excluded_dirs
+        self._profile = profile or on_rule_hit is not None
+        self._on_rule_hit = on_rule_hit
+        self.rules = rules
+
+    @property
+    def rules(self):
+        return self._state.rules
+
+    @rules.setter
+    def rules(self, rules):
+        self._state = self._compile_state(list(rules))
+
+    def _compile_state(self, rules):
+        """
+        Return a _RuleSetState for the given rules, with empty caches. The
+        state is only ever replaced as a whole, and each query reads it
+        once, so queries running while the rules are replaced, such as by
+        an IgnoreFileWatcher, see either the old or the new rules.
+        """
+        if self._profile:
+            stats = _RuleStatsCounter(len(rules), self._on_rule_hit)
+        else:
+            stats = None
+        groups = _compile_rule_groups(rules, stats, self._engine)
+        base_paths = list(groups)
+        # The directory below which exclude_below_excluded_dirs applies.
+        dir_root = base_paths[0] if len(base_paths) == 1 else None
+        cache = dir_cache = None
+        if self._cache_size > 0:
+            cache = _LRUCache(self._cache_size)
+        if self._exclude_below_excluded_dirs and dir_root is not None:
+            dir_cache = _LRUCache(self._cache_size or _DIR_CACHE_SIZE)
+        return _RuleSetState(
+            rules, groups, dir_root, stats, cache, dir_cache
+        )
+
+    def __call__(self, file_path):
+        state = self._state
+        index = self._last_match(state, file_path)
+        return index >= 0 and not state.rules[index].negation
+
+    def check(self, file_path):
+        """
+        Return a CheckResult telling whether file_path is ignored and which
+        rule decided, like git check-ignore -v. Its rule is None if no rule
+        matches.
+        """
+        state = self._state
+        return _check_result(
+            state.rules, file_path, self._last_match(state, file_path)
+        )
+
+    def check_many(self, paths):
+        """Lazily yield a CheckResult for each of paths, in order."""
+        state = self._state
+        for path, index in self._last_match_pairs(state, paths):
+            yield _check_result(state.rules, path, index)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return 'IgnoreRuleSet(%r)' % self.rules
+
+    def cache_info(self):
+        """
+        Return a CacheInfo with the hits, misses, maximum and current size
+        of the result cache, or None if it is disabled.
+        """
+        cache = self._state.cache
+        if cache is None:
+            return None
+        return cache.info()
+
+    def clear_cache(self):
+        state = self._state
+        if state.cache is not None:
+            state.cache.clear()
+        if state.dir_cache is not None:
+            state.dir_cache.clear()
+
+    def rule_stats(self):
+        """
+        Return a RuleStats for each rule, in order, or None if profiling is
+        disabled. Rules which are never hit are candidates for removal;
+        rules with a high time are worth rewriting. Results answered from
+        the caches are not counted.
+        """
+        state = self._state
+        if state.stats is None:
+            return None
+        return state.stats.report(state.rules)
+
+    def clear_stats(self):
+        stats = self._state.stats
+        if stats is not None:
+            stats.clear()
+
+    def match_relative(self, rel_path: str):
+        """
+        Fast path for callers which already have a clean POSIX path relative
+        to the rules' base path, such as 'src/main.pyc' or 'build/'. The path
+        is not normalized in any way.
+        """
+        state = self._state
+        index = _last_match_relative(state, rel_path)
+        return index >= 0 and not state.rules[index].negation
+
+    def _match_pairs(self, paths):
+        state = self._state
+        rules = state.rules
+        for path, index in self._last_match_pairs(state, paths):
+            yield path, index >= 0 and not rules[index].negation
+
+    def _last_match_pairs(self, state, paths):
+        if state.cache is None and state.dir_cache is None:
+            return _last_match_many(state, paths)
+        return ((path, self._last_match(state, path)) for path in paths)
+
+    def _match_normalized(self, path, suffix, is_dir):
+        """
+        Return the rule deciding about path, which was normalized by
+        abspath, or None. For IgnoreTree.
+        """
+        state = self._state
+        index = _last_match_normalized(state, path, suffix, is_dir)
+        return state.rules[index] if index >= 0 else None
+
+    def _last_match(self, state, file_path):
+        """
+        Return the index of the rule of state deciding about file_path: the
+        last matching rule, or with exclude_below_excluded_dirs the rule
+        excluding a parent directory. -1 if there is none.
+        """
+        if type(file_path) != str:
+            file_path = _query_path(file_path)
+        cache = state.cache
+        if cache is not None:
+            index = cache.get(file_path)
+            if index is None:
+                index = _last_match_uncached(state, file_path)
+                cache.put(file_path, index)
+            return index
+        return _last_match_uncached(state, file_path)
+
+    def _replace_rules(self, rules, added, index_map):
+        """
+        Replace the rules, keeping the cached results which the change can't
+        affect. added are the new rules; index_map maps the indices of the
+        kept rules to their new indices.
+        """
+        old_state = self._state
+        new_state = self._compile_state(rules)
+        # If kept rules swapped places, they may now decide differently.
+        new_indices = [index_map[index] for index in sorted(index_map)]
+        kept_in_order = new_indices == sorted(new_indices)
+        # Directory verdicts affect whole subtrees; simply start over.
+        if old_state.cache is not None and old_state.dir_cache is None and \
+                kept_in_order:
+            for path, index in old_state.cache.items():
+                if index >= 0:
+                    if index not in index_map:
+                        # The deciding rule was removed.
+                        continue
+                    index = index_map[index]
+                if any(rule.match(path) for rule in added):
+                    continue
+                new_state.cache.put(path, index)
+        # Publish the new rules together with their cache. Queries still
+        # running on the old state only update the old cache.
+        self._state = new_state
+
+
+# The rules of an IgnoreRuleSet, and everything derived from them. groups is
+# {base_path: _RuleGroup}; dir_root is the base path of all rules, if they
+# share one; stats is a _RuleStatsCounter or None; cache and dir_cache are
+# _LRUCaches or None. dir_cache holds the verdicts for parent directories,
+# and is only there with exclude_below_excluded_dirs and a dir_root.
+_RuleSetState = collections.namedtuple(
+    '_RuleSetState',
+    ['rules', 'groups', 'dir_root', 'stats', 'cache', 'dir_cache']
+)
+
+
+def _check_result(rules, file_path, index):
+    if index < 0:
+        return CheckResult(file_path, None, False)
+    rule = rules[index]
+    return CheckResult(file_path, rule, not rule.negation)
+
+
+def _last_match_many(state, paths):
+    """
+    Yield (path, index of last matching rule of state) for each of paths.
+    Paths in the same directory share the work of relativizing that
+    directory.
+    """
+    groups = list(state.groups.items())
+    rel_dirs = {}
+    for file_path in paths:
+        query = file_path if type(file_path) == str else \
+            _query_path(file_path)
+        abs_path = abspath(query)
+        suffix = _trailing_symbols(query)
+        is_dir = query[-1:] == '/'
+        head, tail = os.path.split(abs_path)
+        best = -1
+        for base_path, group in groups:
+            key = (base_path, head)
+            try:
+                rel_dir = rel_dirs[key]
+            except KeyError:
+                if len(rel_dirs) >= _BATCH_DIR_CACHE_SIZE:
+                    rel_dirs.clear()
+                try:
+                    rel_dir = _relative_to(head, base_path)
+                except ValueError:
+                    rel_dir = None
+                rel_dirs[key] = rel_dir
+            if rel_dir is None or not tail:
+                # The path is the base path itself, the file system root or
+                # not below the base path. Let _relative_to decide.
+                rel_path = _relative_to(abs_path, base_path, suffix)
+            elif rel_dir == '.':
+                rel_path = tail + suffix
+            elif rel_dir[-1] == '/':
+                rel_path = rel_dir + tail + suffix
+            else:
+                rel_path = rel_dir + '/' + tail + suffix
+            index = group.last_match(rel_path, is_dir)
+            if index > best:
+                best = index
+        yield file_path, best
+
+
+def _last_match_uncached(state, file_path):
+    # Normalize once; every group only needs to relativize the result.
+    path = abspath(file_path)
+    if state.dir_cache is not None:
+        index = _excluding_parent(state, Path(path))
+        if index >= 0:
+            return index
+    return _last_match_normalized(
+        state, path, _trailing_symbols(file_path), file_path[-1:] == '/'
+    )
+
+
+def _excluding_parent(state, path):
+    """
+    Return the index of the rule excluding the topmost excluded parent
+    directory of path below the base path, or -1 if there is none.
+    """
+    parents = []
+    for parent in path.parents:
+        if parent == state.dir_root:
+            break
+        parents.append(parent)
+    else:
+        # Not below the base path; let _last_match_normalized complain.
+        return -1
+    rules = state.rules
+    for parent in reversed(parents):
+        index = state.dir_cache.get(parent)
+        if index is None:
+            index = _last_match_normalized(state, parent, '', True)
+            state.dir_cache.put(parent, index)
+        if index >= 0 and not rules[index].negation:
+            return index
+    return -1
+
+
+def _last_match_normalized(state, path, suffix, is_dir):
+    best = -1
+    for base_path, group in state.groups.items():
+        rel_path = _relative_to(path, base_path, suffix)
+        index = group.last_match(rel_path, is_dir)
+        if index > best:
+            best = index
+    return best
+
+
+def _last_match_relative(state, rel_path):
+    is_dir = rel_path[-1:] == '/'
+    if is_dir:
+        rel_path = rel_path[:-1]
+    best = -1
+    for group in state.groups.values():
+        index = group.last_match(rel_path, is_dir)
+        if index > best:
+            best = index
+    return best
+
+
+# The number of directory verdicts IgnoreRuleSet caches for
+# exclude_below_excluded_dirs without a cache_size.
+_DIR_CACHE_SIZE = 4096
+
+# The number of relativized directories IgnoreRuleSet.match_many remembers.
+_BATCH_DIR_CACHE_SIZE = 4096
+
+
+def _compile_rule_groups(rules, stats=None, engine='regex'):
+    """Group rules by base path, as {base_path: _RuleGroup}."""
+    grouped = {}
+    for index, rule in enumerate(rules):
+        grouped.setdefault(rule.base_path, []).append(index)
+    if len(grouped) == 1:
+        # The usual case; a range takes less memory than a list of indices.
+        base_path, = grouped
+        grouped[base_path] = range(len(rules))
+    return {
+        base_path: _RuleGroup(rules, indices, stats, engine)
+        for base_path, indices in grouped.items()
+    }
+
+
+class _RuleGroup:
+    """
+    The rules of an IgnoreRuleSet which share a base path. Matching is done
+    by their _RuleTables, or _SegmentAutomaton with the 'automaton' engine,
+    which repositories with the same rules share. With stats, a
+    _RuleStatsCounter, rules are evaluated one by one instead, and counted.
+    """
+    def __init__(self, rules, indices, stats=None, engine='regex'):
+        self.rules = rules
+        self.indices = indices
+        self.has_slash_rules = any(
+            _sees_slash(rules[index]) for index in indices
+        )
+        self.tables = _ENGINES[engine](rules, indices)
+        self.stats = stats
+        # (index, sees_slash, search) per rule, last rule first, for
+        # evaluating rule by rule.
+        self.searches = None
+        if stats is not None:
+            # Replace the method, so that without profiling last_match
+            # doesn't even check for it.
+            self.last_match = self._last_match_profiled
+
+    def last_match(self, rel_path, is_dir):
+        """
+        Return the index of the last rule matching rel_path, or -1. is_dir
+        tells whether rel_path is a directory.
+        """
+        if '\n' in rel_path:
+            # The lookups and the automaton don't emulate how $ treats a
+            # trailing newline. That's rare enough to evaluate rule by rule.
+            return self._last_match_slow(rel_path, is_dir)
+        if is_dir and self.has_slash_rules:
+            return self.tables.last_match(rel_path, True)
+        return self.tables.last_match(rel_path)
+
+    def _rule_searches(self):
+        searches = self.searches
+        if searches is None:
+            searches = self.searches = [
+                (index, _sees_slash(self.rules[index]),
+                 _search_method(self.rules[index].regex))
+                for index in reversed(self.indices)
+            ]
+        return searches
+
+    def _last_match_slow(self, rel_path, is_dir):
+        for index, sees_slash, search in self._rule_searches():
+            if is_dir and sees_slash:
+                subject = rel_path + '/'
+            else:
+                subject = rel_path
+            if search(subject):
+                return index
+        return -1
+
+    def _last_match_profiled(self, rel_path, is_dir):
+        stats = self.stats
+        start = perf_counter()
+        for index, sees_slash, search in self._rule_searches():
+            if is_dir and sees_slash:
+                subject = rel_path + '/'
+            else:
+                subject = rel_path
+            before = perf_counter()
+            matched = search(subject)
+            now = perf_counter()
+            stats.evaluations[index] += 1
+            stats.times[index] += now - before
+            if matched:
+                stats.hits[index] += 1
+                if stats.on_rule_hit is not None:
+                    stats.on_rule_hit(self.rules[index], rel_path, now - start)
+                return index
+        return -1
+
+
+def _sees_slash(rule):
+    """
+    Whether the rule is matched against directories with a trailing slash.
+    Only directory-only negations such as "!data/**/" need it, as their
+    regexes end with "/$"; all other rules match a directory's path as is.
+    """
+    return rule.negation and rule.directory_only
+
+
+# The result of check(): whether path is ignored, and the IgnoreRule which
+# decided, or None.
+CheckResult = collections.namedtuple(
+    'CheckResult', ['path', 'rule', 'ignored']
+)
+
+
+RuleStats = collections.namedtuple(
+    'RuleStats', ['rule', 'evaluations', 'hits', 'time']
+)
+
+
+class _RuleStatsCounter:
+    """The per-rule counters of a profiling IgnoreRuleSet, by rule index."""
+    def __init__(self, num_rules, on_rule_hit=None):
+        self.num_rules = num_rules
+        self.on_rule_hit = on_rule_hit
+        self.clear()
+
+    def clear(self):
+        self.evaluations = [0] * self.num_rules
+        self.hits = [0] * self.num_rules
+        self.times = [0.0] * self.num_rules
+
+    def report(self, rules):
+        return [
+            RuleStats(rule, evaluations, hits, time)
+            for rule, evaluations, hits, time in zip(
+                rules, self.evaluations, self.hits, self.times
+            )
+        ]
+
+
+# The _RuleTables in use, by the rules they were built from.
+_rule_tables_cache = weakref.WeakValueDictionary()
+
+
+def _rule_tables(rules, indices):
+    """
+    Return _RuleTables for the given rules. The tables only depend on the
+    rules' indices, regexes and literals, not on their base path or source.
+    So repositories with the same rules, for example copies of a common
+    .gitignore, share one instance and its compiled regex.
+    """
+    key = tuple(
+        (index, rules[index].regex, _sees_slash(rules[index])) +
+        _literal_kind(rules[index])
+        for index in indices
+    )
+    tables = _rule_tables_cache.get(key)
+    if tables is None:
+        tables = _rule_tables_cache[key] = _RuleTables(key)
+    return tables
+
+
+class _RuleTables:
+    """
+    Literal patterns such as "node_modules/", "*.pyc" or "/docs/build" are
+    looked up in dicts and a trie of path components. The remaining rules
+    are compiled into alternations of at most 100 rules each. Each lookup
+    yields the index of the last rule it matched; the highest index wins,
+    so negations keep their meaning.
+    """
+    __slots__ = (
+        'names', 'components', 'suffixes', 'trie', 'has_trie',
+        'regexes', 'slash_regexes', 'max_regex_index', 'alternations',
+        'slash_alternations', '__weakref__'
+    )
+
+    def __init__(self, key):
+        # Each of the following maps a literal to the highest index of the
+        # rules with it. For the trie, that's a node's exact and prefix index.
+        self.names = {}
+        self.components = {}
+        self.suffixes = {}
+        self.trie = _TrieNode()
+        self.regexes = []
+        # The indices of the rules of regexes which see a directory's
+        # trailing slash. Those never have literals.
+        self.slash_regexes = set()
+        for index, regex, sees_slash, kind, literal in key:
+            if kind == _NAME:
+                self.names[literal] = index
+            elif kind == _COMPONENT:
+                self.components[literal] = index
+            elif kind == _SUFFIX:
+                self.suffixes[literal] = index
+            elif kind in (_PATH, _PREFIX):
+                node = self.trie
+                for part in literal.split('/'):
+                    node = node.children.setdefault(part, _TrieNode())
+                if kind == _PATH:
+                    node.exact = index
+                else:
+                    node.prefix = index
+            else:
+                self.regexes.append((index, regex))
+                if sees_slash:
+                    self.slash_regexes.add(index)
+        self.has_trie = bool(self.trie.children)
+        self.max_regex_index = self.regexes[-1][0] if self.regexes else -1
+        # Compiled on first use, which keeps parsing cheap for short-lived
+        # processes.
+        self.alternations = None
+        self.slash_alternations = None
+
+    def last_match(self, rel_path, is_dir=False):
+        best = -1
+        if self.names or self.suffixes:
+            basename = rel_path.rpartition('/')[2]
+            best = self.names.get(basename, -1)
+            if self.suffixes:
+                _, dot, extension = basename.rpartition('.')
+                if dot:
+                    index = self.suffixes.get(extension, -1)
+                    if index > best:
+                        best = index
+        if self.components or self.has_trie:
+            parts = rel_path.split('/')
+            if self.components:
+                get = self.components.get
+                for part in parts:
+                    index = get(part, -1)
+                    if index > best:
+                        best = index
+            node = self.trie
+            for part in parts:
+                node = node.children.get(part)
+                if node is None:
+                    break
+                if node.prefix > best:
+                    best = node.prefix
+            else:
+                if node.exact > best:
+                    best = node.exact
+        # A literal rule after every regex rule decides on its own.
+        if self.max_regex_index > best:
+            if is_dir:
+                if self.slash_alternations is None:
+                    self.slash_alternations = _compile_slash_alternations(
+                        self.regexes, self.slash_regexes
+                    )
+                return _match_slash_alternations(
+                    self.slash_alternations, rel_path, best
+                )
+            if self.alternations is None:
+                self.alternations = _compile_alternations(self.regexes)
+            best = _match_alternations(self.alternations, rel_path, best)
+        return best
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'maxsize', 'currsize']
+)
+
+
+class _LRUCache:
+    """A dict which evicts its least recently used entry when full."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the value for key, or None."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def items(self):
+        """The (key, value) pairs, from least to most recently used."""
+        return list(self._entries.items())
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+
+class _TrieNode:
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = -1
+        self.prefix = -1
+
+
+def _literal_kind(rule):
+    """
+    Return (kind, literal) as determined by _translate_pattern for the given
+    rule, or (None, None) if its regex needs to be evaluated.
+    """
+    translation = _rule_translation(rule)
+    if translation is None:
+        return None, None
+    return translation[4], translation[5]
+
+
+def _rule_translation(rule):
+    """
+    Return _translate_pattern(rule.pattern), or None if the rule doesn't
+    behave like its pattern. Rules can also be created directly, with any
+    regex.
+    """
+    translation = _translate_pattern(rule.pattern)
+    if translation is None or translation[0] != rule.regex or \
+            translation[1] != rule.negation or \
+            translation[2] != rule.directory_only:
+        return None
+    return translation
+
+
+def _compile_alternations(regexes):
+    """
+    Compile the given (rule index, regex) pairs into a list of
+    (highest rule index, regex) chunks of at most _ALTERNATION_SIZE rules,
+    from the last rules to the first. One alternation of thousands of rules
+    gets disproportionately slow, as the re module tries each alternative
+    at every position it could start at.
+    """
+    return [
+        (chunk[-1][0], _compile_alternation(chunk))
+        for chunk in (
+            regexes[max(end - _ALTERNATION_SIZE, 0):end]
+            for end in range(len(regexes), 0, -_ALTERNATION_SIZE)
+        )
+    ]
+
+
+# The number of rules per alternation of _compile_alternations.
+_ALTERNATION_SIZE = 100
+
+
+def _match_alternations(alternations, rel_path, best):
+    """
+    Return the index of the last rule of the alternations matching rel_path,
+    if it is higher than best, or best.
+    """
+    for max_index, regex in alternations:
+        if max_index <= best:
+            break
+        m = regex.match(rel_path)
+        if m:
+            # Later chunks were tried first, so this is the last match.
+            return max(int(m.lastgroup[1:]), best)
+    return best
+
+
+def _compile_slash_alternations(regexes, slash_indices):
+    """
+    Return the alternations for matching a directory: those of the given
+    (rule index, regex) pairs whose index isn't in slash_indices, and those
+    of the ones which are, which see the directory's trailing slash.
+    """
+    return (
+        _compile_alternations([
+            pair for pair in regexes if pair[0] not in slash_indices
+        ]),
+        _compile_alternations([
+            pair for pair in regexes if pair[0] in slash_indices
+        ]),
+    )
+
+
+def _match_slash_alternations(slash_alternations, rel_path, best):
+    """_match_alternations for the directory rel_path."""
+    others, slashed = slash_alternations
+    best = _match_alternations(others, rel_path, best)
+    return _match_alternations(slashed, rel_path + '/', best)
+
+
+def _compile_alternation(regexes):
+    """
+    Compile the given (rule index, regex) pairs into one regex. Each rule
+    becomes a named alternative r<index>, ordered from the last rule to the
+    first. So match() finds the last matching rule, and lastgroup tells
+    which one it is.
+    """
+    seps_group = _seps_group()
+    unanchored_prefix = '(^|%s)' % seps_group
+    alternatives = []
+    for index, regex in reversed(regexes):
+        # Turn the rule's search() semantics into a match() from the start
+        # of the path. Unanchored rules can only start after a separator, so
+        # only those positions need to be tried.
+        if regex.startswith(unanchored_prefix):
+            regex = '(?:(?s:.*)%s)?%s' % (
+                seps_group, regex[len(unanchored_prefix):]
+            )
+        elif not regex.startswith('^'):
+            regex = '(?s:.*?)(?:%s)' % regex
+        alternatives.append('(?P<r%d>%s)' % (index, regex))
+    return re.compile('|'.join(alternatives))
+
+
+def _rule_automaton(rules, indices):
+    """
+    Return a _SegmentAutomaton for the given rules, shared like
+    _rule_tables.
+    """
+    key = tuple(
+        (index, rules[index].regex, _sees_slash(rules[index]),
+         _segment_tokens(rules[index]))
+        for index in indices
+    )
+    automaton = _automaton_cache.get(key)
+    if automaton is None:
+        automaton = _automaton_cache[key] = _SegmentAutomaton(key)
+    return automaton
+
+
+# The _SegmentAutomatons in use, by the rules they were built from.
+_automaton_cache = weakref.WeakValueDictionary()
+
+
+# The tokens of _segment_tokens, besides (_LITERAL, name) and (_GLOB, glob):
+_LITERAL = 'literal'  # A path component equal to name.
+_GLOB = 'glob'  # A path component matching glob, which has no "**".
+_ANY = ('any',)  # Any one path component.
+_STAR = ('star',)  # Any number of path components, including none.
+
+
+def _segment_tokens(rule):
+    """
+    Return the rule's pattern as a tuple of tokens, each matching path
+    components, or None if the automaton can't express the rule's regex
+    exactly. Then the regex is used.
+    """
+    if _rule_translation(rule) is None:
+        return None
+    pattern, negation, directory_only, anchored = _parse_pattern(rule.pattern)
+    if not _brackets_within_components(pattern):
+        return None
+    # An unanchored pattern can match from any component on.
+    tokens = [] if anchored else [_STAR]
+    parts = pattern.split('/')
+    for i, part in enumerate(parts):
+        if part == '**':
+            if i < len(parts) - 1:
+                # "a/**/b" matches "a/b", "a/x/b", "a/x/y/b", ...
+                tokens.append(_STAR)
+            else:
+                # "a/**" matches everything inside a.
+                tokens += [_ANY, _STAR]
+        elif '**' in part:
+            return None
+        elif any(c in part for c in '*?['):
+            tokens.append((_GLOB, part))
+        else:
+            tokens.append((_LITERAL, part))
+    if directory_only:
+        if negation:
+            # Only matches with a trailing slash, which the automaton sees
+            # as an empty last component.
+            tokens.append((_LITERAL, ''))
+        else:
+            # Also matches everything inside.
+            tokens.append(_STAR)
+    return tuple(tokens)
+
+
+def _brackets_within_components(pattern):
+    """
+    Whether no bracket expression of the pattern can match a "/" or contains
+    one, like "[!a]" and "[a/b]". Those span path components.
+    """
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c != '[':
+            continue
+        # Find the end of the bracket like fnmatch_pathname_to_regex does.
+        j = i
+        if j < n and pattern[j] == '!':
+            j += 1
+        if j < n and pattern[j] == ']':
+            j += 1
+        while j < n and pattern[j] != ']':
+            j += 1
+        if j < n:
+            bracket = pattern[i - 1:j + 1]
+            if '/' in bracket or _glob_component_regex(bracket)('/'):
+                return False
+            i = j + 1
+    return True
+
+
+@functools.lru_cache(maxsize=1024)
+def _glob_component_regex(glob):
+    """The match method of a regex for one path component matching glob."""
+    return re.compile(
+        fnmatch_pathname_to_regex(glob, False, False, anchored=True)
+    ).match
+
+
+class _GlobNode:
+    """
+    A node of the trie of _segment_tokens of _SegmentAutomaton. Its children
+    are reached by matching one path component, except for star, which
+    matches any number of components; as a star node loops on any
+    component. accept is the highest index of the rules ending here;
+    accept_slash is that of the rules among them which see a directory's
+    trailing slash, and accept_other that of the others.
+    """
+    __slots__ = (
+        'literals', 'globs', 'glob_index', 'any', 'star', 'loops', 'accept',
+        'accept_other', 'accept_slash'
+    )
+
+    def __init__(self, loops=False):
+        self.literals = {}
+        self.globs = {}
+        # A _GlobIndex of globs, built on first use.
+        self.glob_index = None
+        self.any = None
+        self.star = None
+        self.loops = loops
+        self.accept = -1
+        self.accept_other = -1
+        self.accept_slash = -1
+
+    def child(self, token):
+        if token is _STAR:
+            if self.star is None:
+                self.star = _GlobNode(loops=True)
+            return self.star
+        if token is _ANY:
+            if self.any is None:
+                self.any = _GlobNode()
+            return self.any
+        kind, text = token
+        children = self.literals if kind == _LITERAL else self.globs
+        node = children.get(text)
+        if node is None:
+            node = children[text] = _GlobNode()
+        return node
+
+
+class _GlobIndex:
+    """
+    The glob children of a _GlobNode, indexed so that finding those which
+    match a path component doesn't take one regex per glob. Globs are
+    looked up by their literal start, such as "lib" of "lib*.so", or else
+    by their literal end, such as ".py" of "*.py", and only the globs found
+    are matched by their regexes. "*", "*.py" and "lib*" need no regex.
+    """
+    __slots__ = (
+        'heads', 'head_lengths', 'tails', 'tail_lengths', 'others'
+    )
+
+    def __init__(self, globs):
+        # Each maps a literal to a list of (match, child), where match is
+        # the match method of the glob's regex, or None if the literal
+        # implies a match.
+        self.heads, self.tails, self.others = {}, {}, []
+        for glob, child in globs.items():
+            head, tail = _literal_ends(glob)
+            if glob in ('*' + tail, head + '*'):
+                match = None
+            else:
+                match = re.compile(fnmatch_pathname_to_regex(
+                    glob, False, False, anchored=True
+                )).match
+            if head:
+                self.heads.setdefault(head, []).append((match, child))
+            elif tail:
+                self.tails.setdefault(tail, []).append((match, child))
+            else:
+                self.others.append((match, child))
+        self.head_lengths = sorted({len(head) for head in self.heads})
+        self.tail_lengths = sorted({len(tail) for tail in self.tails})
+
+    def match(self, component, nodes):
+        """Append the children whose globs match component to nodes."""
+        n = len(component)
+        if self.heads:
+            get = self.heads.get
+            for length in self.head_lengths:
+                if length > n:
+                    break
+                candidates = get(component[:length])
+                if candidates is not None:
+                    _match_candidates(candidates, component, nodes)
+        if self.tails:
+            get = self.tails.get
+            for length in self.tail_lengths:
+                if length > n:
+                    break
+                candidates = get(component[n - length:])
+                if candidates is not None:
+                    _match_candidates(candidates, component, nodes)
+        if self.others:
+            _match_candidates(self.others, component, nodes)
+
+
+def _match_candidates(candidates, component, nodes):
+    for match, child in candidates:
+        if match is None or match(component):
+            nodes.append(child)
+
+
+def _literal_ends(glob):
+    """
+    Return the literal text which the glob starts with and the literal text
+    it ends with. Both are empty if the glob has no wildcard.
+    """
+    wildcards = [i for i, c in enumerate(glob) if c in '*?[]\\']
+    if not wildcards:
+        return '', ''
+    return glob[:wildcards[0]], glob[wildcards[-1] + 1:]
+
+
+class _DFAState:
+    """
+    A set of _GlobNodes the automaton can be in, with its transitions, and
+    the highest accept indices of its nodes.
+    """
+    __slots__ = (
+        'nodes', 'accept', 'accept_other', 'accept_slash', 'transitions'
+    )
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.accept = max((node.accept for node in nodes), default=-1)
+        self.accept_slash = max(
+            (node.accept_slash for node in nodes), default=-1
+        )
+        self.accept_other = max(
+            (node.accept_other for node in nodes), default=-1
+        )
+        # Path component -> _DFAState.
+        self.transitions = {}
+
+
+class _SegmentAutomaton:
+    """
+    The rules' patterns as a trie of path component tokens, with shared
+    prefixes. Matching a path runs all rules at once, one component at a
+    time, through the sets of trie nodes they can be in. Those sets are the
+    states of a deterministic automaton, which is built lazily: the
+    transitions taken are cached, so a path's components are mostly dict
+    lookups, as paths in the same directories take the same transitions.
+    A new transition looks up the component in each node's literals and
+    _GlobIndex, rather than trying every glob.
+    Rules which the trie can't express are compiled into alternations like
+    by _RuleTables. The highest index of the rules matched wins.
+    A directory's trailing slash, which only directory-only negations see,
+    is one more, empty component for them.
+    """
+    __slots__ = (
+        'root', 'regexes', 'slash_regexes', 'max_regex_index',
+        'alternations', 'slash_alternations', 'start', 'states',
+        'num_transitions', '__weakref__'
+    )
+
+    def __init__(self, key):
+        self.root = _GlobNode()
+        self.regexes = []
+        self.slash_regexes = set()
+        for index, regex, sees_slash, tokens in key:
+            if tokens is None:
+                self.regexes.append((index, regex))
+                if sees_slash:
+                    self.slash_regexes.add(index)
+                continue
+            node = self.root
+            for token in tokens:
+                node = node.child(token)
+            node.accept = index
+            if sees_slash:
+                node.accept_slash = index
+            else:
+                node.accept_other = index
+        self.max_regex_index = self.regexes[-1][0] if self.regexes else -1
+        self.alternations = None
+        self.slash_alternations = None
+        self._reset()
+
+    def _reset(self):
+        self.start = _DFAState(_closure([self.root]))
+        # The states by their nodes, so that the transitions learned from
+        # one path are reused by others.
+        self.states = {self.start.nodes: self.start}
+        self.num_transitions = 0
+
+    def last_match(self, rel_path, is_dir=False):
+        state = self.start
+        for component in rel_path.split('/'):
+            next_state = state.transitions.get(component)
+            if next_state is None:
+                next_state = self._transition(state, component)
+            state = next_state
+            if not state.nodes:
+                break
+        if is_dir:
+            return self._last_match_dir(rel_path, state)
+        best = state.accept
+        if self.max_regex_index > best:
+            if self.alternations is None:
+                self.alternations = _compile_alternations(self.regexes)
+            best = _match_alternations(self.alternations, rel_path, best)
+        return best
+
+    def _last_match_dir(self, rel_path, state):
+        best = state.accept_other
+        if state.nodes:
+            slash_state = state.transitions.get('')
+            if slash_state is None:
+                slash_state = self._transition(state, '')
+            if slash_state.accept_slash > best:
+                best = slash_state.accept_slash
+        if self.max_regex_index > best:
+            if self.slash_alternations is None:
+                self.slash_alternations = _compile_slash_alternations(
+                    self.regexes, self.slash_regexes
+                )
+            best = _match_slash_alternations(
+                self.slash_alternations, rel_path, best
+            )
+        return best
+
+    def _transition(self, state, component):
+        nodes = []
+        for node in state.nodes:
+            if node.loops:
+                nodes.append(node)
+            child = node.literals.get(component)
+            if child is not None:
+                nodes.append(child)
+            if node.globs:
+                glob_index = node.glob_index
+                if glob_index is None:
+                    glob_index = node.glob_index = _GlobIndex(node.globs)
+                glob_index.match(component, nodes)
+            if node.any is not None:
+                nodes.append(node.any)
+        nodes = _closure(nodes)
+        # Keep the memory of the cached transitions bounded; start over when
+        # there are too many.
+        if self.num_transitions >= _AUTOMATON_TRANSITIONS:
+            self._reset()
+        next_state = self.states.get(nodes)
+        if next_state is None:
+            next_state = self.states[nodes] = _DFAState(nodes)
+        state.transitions[component] = next_state
+        self.num_transitions += 1
+        return next_state
+
+
+# The number of transitions a _SegmentAutomaton caches.
+_AUTOMATON_TRANSITIONS = 100000
+
+
+def _closure(nodes):
+    """The nodes and the star nodes reachable from them, as a frozenset."""
+    result = set(nodes)
+    todo = list(result)
+    while todo:
+        star = todo.pop().star
+        if star is not None and star not in result:
+            result.add(star)
+            todo.append(star)
+    return frozenset(result)
+
+
+# The matching engines of IgnoreRuleSet, by name.
+_ENGINES = {'regex': _rule_tables, 'automaton': _rule_automaton}
+
+
+class IgnoreFile(IgnoreRuleSet):
+    """
+    An IgnoreRuleSet for a .gitignore file which can be reloaded when the
+    file changes. reload() parses only the lines which changed and keeps
+    the IgnoreRule objects of the others. Cached results which the changed
+    rules can't affect are kept, too. A missing file has no rules. Further
+    keyword arguments are passed to IgnoreRuleSet.
+    """
+    def __init__(self, full_path, base_dir=None, **kwargs):
+        if base_dir is None:
+            base_dir = dirname(full_path)
+        self.full_path = full_path
+        self.base_dir = _normalize_path(base_dir)
+        self._signature = self._digest = None
+        super().__init__([], **kwargs)
+        self.reload()
+
+    def __repr__(self):
+        return 'IgnoreFile(%r)' % self.full_path
+
+    def reload(self):
+        """
+        Re-read the file if its modification time or size changed. Return
+        True if its contents changed.
+        """
+        try:
+            stat = os.stat(self.full_path)
+        except FileNotFoundError:
+            signature, data = None, b''
+        else:
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self._signature:
+                return False
+            with open(self.full_path, 'rb') as ignore_file:
+                data = ignore_file.read()
+        self._signature = signature
+        digest = hashlib.sha1(data).digest()
+        if digest == self._digest:
+            return False
+        self._digest = digest
+        # Decode like parse_gitignore's open() does.
+        lines = io.TextIOWrapper(io.BytesIO(data))
+        self._update_rules(line.rstrip('\n') for line in lines)
+        return True
+
+    def _update_rules(self, lines):
+        old_rules = {}
+        for index, rule in enumerate(self.rules):
+            old_rules.setdefault(rule.pattern, []).append((index, rule))
+        rules, added, index_map = [], [], {}
+        for line_no, line in enumerate(lines, start=1):
+            source = (self.full_path, line_no)
+            unchanged = old_rules.get(line)
+            if unchanged:
+                index, rule = unchanged.pop(0)
+                index_map[index] = len(rules)
+                if rule.source != source:
+                    rule = rule._replace(source=source)
+            else:
+                rule = rule_from_pattern(
+                    line, base_path=self.base_dir, source=source
+                )
+                if not rule:
+                    continue
+                added.append(rule)
+            rules.append(rule)
+        self._replace_rules(rules, added, index_map)
+
+
+class IgnoreFileWatcher:
+    """
+    Keeps IgnoreFiles up to date by calling their reload() every interval
+    seconds on a background thread, between start() and stop(). It can also
+    be used as a context manager. poll() checks once, without a thread. The
+    optional callback is called with each IgnoreFile that changed.
+    """
+    def __init__(self, ignore_files, interval=1.0, callback=None):
+        self.ignore_files = list(ignore_files)
+        self.interval = interval
+        self.callback = callback
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        """Reload the files now. Return those which changed."""
+        changed = [f for f in self.ignore_files if f.reload()]
+        if self.callback is not None:
+            for ignore_file in changed:
+                self.callback(ignore_file)
+        return changed
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.poll()
+
+
+def parse_gitignore_tree(root_dir, excludes_file=None, engine=None):
+    """
+    Return a matcher for the git repository, or any directory tree, at
+    root_dir. Like git, it honors the .gitignore files in root_dir and its
+    subdirectories, .git/info/exclude and core.excludesFile. Pass
+    excludes_file to use that file instead of core.excludesFile, or False to
+    use none. engine is passed to the IgnoreRuleSet of each file.
+    """
+    return IgnoreTree(root_dir, excludes_file, engine)
+
+
+class IgnoreTree(_Matcher):
+    """
+    A callable matcher for a whole directory tree. .gitignore files are
+    discovered lazily: the first query below a directory reads the
+    .gitignore files of that directory and its ancestors. The resulting
+    stack of rule sets is cached per directory, and a query evaluates only
+    its directory's stack, from the deepest .gitignore up to
+    core.excludesFile. The first rule set with a matching rule decides.
+    As in git, nothing below an excluded directory can be re-included: the
+    rule excluding the directory decides about everything below it, and
+    the .gitignore files below it are never read.
+    Like git, it never considers anything inside .git: check() reports
+    git_dir_rule, a rule with the pattern ".git" and no source, as the rule
+    excluding those paths.
+    """
+    def __init__(self, root_dir, excludes_file=None, engine=None):
+        if engine is not None and engine not in _ENGINES:
+            raise ValueError('Unknown engine %r' % engine)
+        self._engine = engine
+        self.root_dir = _normalize_path(root_dir)
+        self.git_dir_rule = rule_from_pattern('.git', base_path=self.root_dir)
+        git_dir = _git_common_dir(_git_dir(self.root_dir))
+        if excludes_file is None:
+            excludes_file = _core_excludes_file(git_dir)
+        base_stack = []
+        for path in (excludes_file, join(git_dir, 'info', 'exclude')):
+            rule_set = path and _parse_gitignore_if_exists(
+                path, self.root_dir, self._engine
+            )
+            if rule_set:
+                base_stack.append(rule_set)
+        self._base_stack = tuple(base_stack)
+        self._stacks = {}
+
+    def __call__(self, file_path):
+        return self.check(file_path).ignored
+
+    def check(self, file_path):
+        """
+        Return a CheckResult telling whether file_path is ignored and which
+        rule decided, like git check-ignore -v. Its rule is None if no rule
+        matches, and git_dir_rule for the paths in .git.
+        """
+        query = file_path if type(file_path) == str else \
+            _query_path(file_path)
+        path = abspath(query)
+        rel_path = _relative_to(path, self.root_dir)
+        if rel_path == '.':
+            return CheckResult(file_path, None, False)
+        rel_dir, _, _ = rel_path.rpartition('/')
+        # Like git, never consider anything inside .git.
+        if '.git' in rel_path.split('/'):
+            return CheckResult(file_path, self.git_dir_rule, True)
+        stack, excluding_rule = self._stack(rel_dir)
+        if excluding_rule is not None:
+            return CheckResult(file_path, excluding_rule, True)
+        rule = _match_stack(
+            stack, path, _trailing_symbols(query), query[-1:] == '/'
+        )
+        if rule is not None:
+            return CheckResult(file_path, rule, not rule.negation)
+        return CheckResult(file_path, None, False)
+
+    def __repr__(self):
+        return 'IgnoreTree(%r)' % str(self.root_dir)
+
+    def _stack(self, rel_dir):
+        """
+        Return (stack, excluding_rule) for the directory rel_dir, a POSIX
+        path relative to root_dir, or '' for root_dir itself. stack are the
+        rule sets applying to its entries. excluding_rule is the rule which
+        excludes rel_dir or one of its ancestors, or None.
+        """
+        try:
+            return self._stacks[rel_dir]
+        except KeyError:
+            pass
+        if rel_dir:
+            stack, excluding_rule = self._stack(rel_dir.rpartition('/')[0])
+            directory = _normalize_path(join(self.root_dir, rel_dir))
+            if excluding_rule is None:
+                # Matched as a directory, so that both "!/src" and "!src/"
+                # re-include it.
+                rule = _match_stack(stack, str(directory), '', True)
+                if rule is not None and not rule.negation:
+                    excluding_rule = rule
+        else:
+            stack, excluding_rule = self._base_stack, None
+            directory = self.root_dir
+        if excluding_rule is None:
+            rule_set = _parse_gitignore_if_exists(
+                join(directory, '.gitignore'), directory, self._engine
+            )
+            if rule_set:
+                stack += (rule_set,)
+        result = self._stacks[rel_dir] = stack, excluding_rule
+        return result
+
+
+def _match_stack(stack, path, suffix, is_dir):
+    """
+    Return the rule deciding about path, normalized by abspath, in the given
+    stack of IgnoreRuleSets, or None.
+    """
+    for rule_set in reversed(stack):
+        rule = rule_set._match_normalized(path, suffix, is_dir)
+        if rule is not None:
+            return rule
+    return None
+
+
+def _parse_gitignore_if_exists(full_path, base_dir, engine=None):
+    try:
+        return parse_gitignore(full_path, base_dir, engine=engine)
+    except OSError:
+        return None
+
+
+def _git_dir(root_dir) -> str:
+    """The .git directory of the work tree at root_dir."""
+    git_dir = join(root_dir, '.git')
+    # In worktrees and submodules, .git is a file pointing to the real one.
+    try:
+        with open(git_dir) as git_file:
+            content = git_file.read().strip()
+    except OSError:
+        return git_dir
+    if content.startswith('gitdir:'):
+        return join(root_dir, content[len('gitdir:'):].strip())
+    return git_dir
+
+
+def _git_common_dir(git_dir) -> str:
+    """
+    The directory of git_dir's repository with its info/exclude and config.
+    In a linked worktree, git_dir is .git/worktrees/<name> of the main work
+    tree, and its commondir file points to the main .git directory.
+    """
+    try:
+        with open(join(git_dir, 'commondir')) as commondir_file:
+            common_dir = commondir_file.read().strip()
+    except OSError:
+        return git_dir
+    return abspath(join(git_dir, common_dir))
+
+
+def _core_excludes_file(git_dir) -> str:
+    """The path of git's core.excludesFile for the given .git directory."""
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or \
+        join(os.path.expanduser('~'), '.config')
+    excludes_file = None
+    # In order of increasing precedence:
+    for config in (join(xdg_config_home, 'git', 'config'),
+                   join(os.path.expanduser('~'), '.gitconfig'),
+                   join(git_dir, 'config')):
+        excludes_file = \
+            _read_git_config(config, 'core', 'excludesfile') or excludes_file
+    if excludes_file is None:
+        return join(xdg_config_home, 'git', 'ignore')
+    return os.path.expanduser(excludes_file)
+
+
+def _read_git_config(config_path, section, key):
+    """
+    Return the last value of section.key in the given git config file, or
+    None. Only supports the simple "key = value" syntax.
+    """
+    value = None
+    current_section = None
+    try:
+        with open(config_path) as config_file:
+            for line in config_file:
+                line = line.strip()
+                if line.startswith('['):
+                    current_section = line[1:line.find(']')].strip().lower()
+                    continue
+                if current_section != section or '=' not in line:
+                    continue
+                name, _, rest = line.partition('=')
+                if name.strip().lower() == key:
+                    rest = rest.strip()
+                    if len(rest) >= 2 and rest[0] == rest[-1] == '"':
+                        rest = rest[1:-1]
+                    value = rest
+    except OSError:
+        pass
+    return value
+
+
+async def _achunks(paths, chunk_size):
+    """Yield lists of chunk_size items of an iterable or async iterable."""
+    chunk = []
+    if hasattr(paths, '__aiter__'):
+        async for path in paths:
+            chunk.append(path)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    else:
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+# scan() splits the tree at most this many levels deep, until it has this
+# many subtrees per worker.
+_SCAN_SPLIT_DEPTH = 3
+_SCAN_SUBTREES_PER_WORKER = 4
+
+# The matcher of a scan() or classify_paths() worker process.
+_worker_matcher = None
+
+
+def _init_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _scan_subtree(matcher, top):
+    """The unignored file paths below top, for scan()."""
+    if matcher is None:
+        matcher = _worker_matcher
+    return [
+        join(dirpath, name)
+        for dirpath, _, filenames in matcher.walk(top)
+        for name in filenames
+    ]
+
+
+def classify_paths(matches, paths_file, out_file, separator=b'\n',
+                   ignored=True, workers=None, chunk_size=10000,
+                   on_error=None):
+    """
+    Read paths terminated by separator, such as b'\0' for the output of
+    find -print0, from the binary file paths_file, and write those which the
+    matcher matches ignores to the binary file out_file, each followed by
+    separator. Pass ignored=False to write the unignored paths instead.
+    Relative paths are resolved against the working directory. The paths
+    are read and matched in chunks of chunk_size paths, so memory use does
+    not grow with the input. Large inputs are matched by a pool of worker
+    processes, by default one per CPU; the output keeps the input's order.
+    Paths which the matcher can't match, such as paths outside its base
+    directory, count as not ignored, and on_error, if given, is called
+    with each of them and the error message.
+    Return the number of paths written.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = None
+    pending = collections.deque()
+    num_written = 0
+    try:
+        for i, chunk in enumerate(
+                _read_chunks(paths_file, separator, chunk_size)):
+            if executor is None and workers > 1 and \
+                    i == _CLASSIFY_SERIAL_CHUNKS:
+                executor = ProcessPoolExecutor(
+                    workers, initializer=_init_worker, initargs=(matches,)
+                )
+            if executor is None:
+                results = [
+                    _classify_chunk(matches, chunk, separator, ignored)
+                ]
+            else:
+                pending.append(executor.submit(
+                    _classify_chunk, None, chunk, separator, ignored
+                ))
+                # Bound the chunks in flight.
+                results = []
+                while len(pending) > 2 * workers:
+                    results.append(pending.popleft().result())
+            for data, count, errors in results:
+                _report_errors(errors, on_error)
+                out_file.write(data)
+                num_written += count
+        while pending:
+            data, count, errors = pending.popleft().result()
+            _report_errors(errors, on_error)
+            out_file.write(data)
+            num_written += count
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+    return num_written
+
+
+# classify_paths() matches this many chunks itself, before it starts worker
+# processes, so that small inputs don't pay for starting them.
+_CLASSIFY_SERIAL_CHUNKS = 4
+
+# The number of bytes classify_paths() reads at a time.
+_CLASSIFY_READ_SIZE = 1 << 16
+
+
+def _read_chunks(paths_file, separator, chunk_size):
+    """
+    Yield lists of at most chunk_size of the non-empty records, terminated
+    by separator, read from the binary file paths_file.
+    """
+    rest = b''
+    chunk = []
+    while True:
+        block = paths_file.read(_CLASSIFY_READ_SIZE)
+        if not block:
+            break
+        records = (rest + block).split(separator)
+        rest = records.pop()
+        chunk.extend(record for record in records if record)
+        while len(chunk) >= chunk_size:
+            yield chunk[:chunk_size]
+            del chunk[:chunk_size]
+    if rest:
+        chunk.append(rest)
+    while chunk:
+        yield chunk[:chunk_size]
+        del chunk[:chunk_size]
+
+
+def _classify_chunk(matcher, paths, separator, ignored):
+    """
+    Return the output of classify_paths() for paths, the number of paths in
+    it, and a list of (path, message) for the paths which couldn't be
+    matched.
+    """
+    if matcher is None:
+        matcher = _worker_matcher
+    errors = []
+    try:
+        selected = list(matcher.filter(paths, ignored))
+    except ValueError:
+        # Some path is outside the base directory. Find out which, matching
+        # path by path.
+        selected = []
+        for path in paths:
+            try:
+                is_ignored = matcher(path)
+            except ValueError as error:
+                errors.append((path, str(error)))
+                is_ignored = False
+            if is_ignored == ignored:
+                selected.append(path)
+    data = b''.join(path + separator for path in selected)
+    return data, len(selected), errors
+
+
+def _report_errors(errors, on_error):
+    if on_error is not None:
+        for path, message in errors:
+            on_error(path, message)
+
+
+def _print_error(path, message):
+    print('gitignore_parser: %s: %s' % (os.fsdecode(path), message),
+          file=sys.stderr)
+
+
+def main(argv=None):
+    """The command line interface. Run python -m gitignore_parser -h."""
+    # Imported here, as most users of this module don't need it.
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='gitignore_parser',
+        description='Print those of a list of paths which are ignored.'
+    )
+    parser.add_argument(
+        'ignore_file', metavar='IGNORE',
+        help='a .gitignore file, or a directory to honor all of its '
+             '.gitignore files, .git/info/exclude and core.excludesFile'
+    )
+    parser.add_argument(
+        'paths_file', metavar='PATHS', nargs='?', default='-',
+        help='a file with the paths, one per line; - for standard input, '
+             'the default'
+    )
+    parser.add_argument(
+        '-z', '--null', action='store_true',
+        help='separate the paths by NUL characters instead of newlines, in '
+             'the input and output'
+    )
+    parser.add_argument(
+        '-n', '--unignored', action='store_true',
+        help='print the paths which are not ignored instead'
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        help='the number of worker processes for large inputs; by default '
+             'one per CPU'
+    )
+    parser.add_argument(
+        '--engine', choices=sorted(_ENGINES),
+        help='the matching engine'
+    )
+    args = parser.parse_args(argv)
+    if os.path.isdir(args.ignore_file):
+        matches = parse_gitignore_tree(args.ignore_file, engine=args.engine)
+    else:
+        matches = parse_gitignore(args.ignore_file, engine=args.engine)
+    separator = b'\0' if args.null else b'\n'
+    out_file = sys.stdout.buffer
+    kwargs = dict(
+        separator=separator, ignored=not args.unignored, workers=args.workers,
+        on_error=_print_error
+    )
+    try:
+        if args.paths_file == '-':
+            classify_paths(matches, sys.stdin.buffer, out_file, **kwargs)
+        else:
+            with open(args.paths_file, 'rb') as paths_file:
+                classify_paths(matches, paths_file, out_file, **kwargs)
+        out_file.flush()
+    except BrokenPipeError:
+        # The reader, such as head, has exited. Point stdout at devnull so
+        # that flushing it at exit doesn't raise again.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, out_file.fileno())
+        sys.exit(1)
+
 
 # Frustratingly, python's fnmatch doesn't provide the FNM_PATHNAME
 # option that .gitignore's behavior depends on.
@@ -160,10 +2358,8 @@ def fnmatch_pathname_to_regex(
     """
     i, n = 0, len(pattern)
 
-    seps = [re.escape(os.sep)]
-    if os.altsep is not None:
-        seps.append(re.escape(os.altsep))
-    seps_group = '[' + '|'.join(seps) + ']'
+    seps = _seps()
+    seps_group = _seps_group()
     nonsep = r'[^{}]'.format('|'.join(seps))
 
     res = []
@@ -230,6 +2426,104 @@ def _normalize_path(path: Union[str, Path]) -> Path:
     return Path(abspath(path))
 
 
+def _seps():
+    seps = [re.escape(os.sep)]
+    if os.altsep is not None:
+        seps.append(re.escape(os.altsep))
+    return seps
+
+
+def _seps_group():
+    return '[' + '|'.join(_seps()) + ']'
+
+
+def _query_path(file_path) -> str:
+    """
+    Return a path given as bytes, an os.PathLike or an os.DirEntry as a str
+    for matching. bytes are decoded like os.fsdecode does, which keeps
+    undecodable bytes. Directory entries get a trailing slash, as if they
+    were directories queried as such, without a stat call on most
+    platforms.
+    """
+    if isinstance(file_path, os.DirEntry):
+        path = os.fsdecode(file_path.path)
+        if file_path.is_dir(follow_symlinks=False) and path[-1:] != '/':
+            path += '/'
+        return path
+    return os.fsdecode(file_path)
+
+
+def _relative_path(abs_path: Union[str, Path], base_path) -> str:
+    """Return abs_path as a POSIX string relative to base_path, if given."""
+    return _relative_to(
+        abspath(abs_path), base_path, _trailing_symbols(abs_path)
+    )
+
+
+def _relative_to(path: Union[str, Path], base_path, suffix: str = '') -> str:
+    """
+    Like _relative_path, for a path that was already normalized: a Path, or
+    a str as returned by abspath. The latter avoids creating Path objects.
+    """
+    if type(path) == str:
+        rel_path = _relative_str(path, base_path)
+    elif base_path:
+        rel_path = path.relative_to(base_path).as_posix()
+    else:
+        rel_path = path.as_posix()
+    rel_path += suffix
+    if rel_path.startswith('./'):
+        rel_path = rel_path[2:]
+    return rel_path
+
+
+def _relative_str(path: str, base_path) -> str:
+    """_relative_to for a str path."""
+    if not base_path:
+        return path.replace(os.sep, '/')
+    base = str(base_path)
+    if path.startswith(base):
+        rest = path[len(base):]
+        if not rest:
+            return '.'
+        if rest[0] == os.sep:
+            return rest[1:].replace(os.sep, '/')
+        if base[-1] == os.sep:
+            # base_path is a file system root.
+            return rest.replace(os.sep, '/')
+    # Let Path decide, eg. about case-insensitive paths on Windows, or raise
+    # ValueError.
+    return Path(path).relative_to(base_path).as_posix()
+
+
+def _trailing_symbols(abs_path: Union[str, Path]) -> str:
+    """
+    Path() strips the trailing following symbols on windows, so we need to
+    preserve them: ' ', '.'
+    """
+    if not sys.platform.startswith('win'):
+        return ''
+    return ' ' * _count_trailing_symbol(' ', abs_path) + \
+        '.' * _count_trailing_symbol('.', abs_path)
+
+
+# Recently used base paths, so rule sets for the same directory share one
+# Path object.
+_interned_paths = {}
+_INTERNED_PATHS_SIZE = 4096
+
+
+def _intern_path(path: Path) -> Path:
+    try:
+        return _interned_paths[path]
+    except KeyError:
+        pass
+    if len(_interned_paths) >= _INTERNED_PATHS_SIZE:
+        _interned_paths.clear()
+    _interned_paths[path] = path
+    return path
+
+
 def _count_trailing_symbol(symbol: str, text: str) -> int:
     """Count the number of trailing characters in a string."""
     count = 0
@@ -239,3 +2533,7 @@ def _count_trailing_symbol(symbol: str, text: str) -> int:
         else:
             break
     return count
+
+
+if __name__ == '__main__':
+    main()
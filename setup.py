@@ -17,6 +17,9 @@ setup(
     author_email='michael+removethisifyouarehuman@herrmann.io',
     url='https://github.com/mherrmann/gitignore_parser',
     py_modules=['gitignore_parser'],
+    entry_points={
+        'console_scripts': ['gitignore_parser = gitignore_parser:main'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -1,8 +1,21 @@
+from asyncio import run
 from unittest.mock import patch, mock_open
+from os import fsencode, scandir, utime
+from os.path import dirname, join
+from io import BytesIO
 from pathlib import Path
+from random import Random
 from tempfile import TemporaryDirectory
+from threading import Event, Thread
+import pickle
+import subprocess
+import sys
 
-from gitignore_parser import parse_gitignore, parse_gitignore_str
+from gitignore_parser import parse_gitignore, parse_gitignore_str, \
+    parse_gitignore_tree, parse_gitignore_lines, iter_gitignore_rules, \
+    handle_negation, rule_from_pattern, optimize_rules, IgnoreFile, \
+    IgnoreFileWatcher, IgnoreRuleSet, RuleStats, classify_paths
+import gitignore_parser
 
 from unittest import TestCase, main, SkipTest
 
@@ -243,5 +256,889 @@ data/**
                 matches = parse_gitignore_str('file.txt', base_dir=str(link_dir))
                 self.assertTrue(matches(file))
 
+    def test_last_matching_rule_wins_among_many_rules(self):
+        lines = ['*.tmp%d' % i for i in range(300)]
+        lines += ['!keep.tmp7', 'build/', '!build/', 'keep.tmp7']
+        matches = parse_gitignore_str('\n'.join(lines), base_dir='/home/michael')
+        self.assertTrue(matches('/home/michael/a.tmp299'))
+        self.assertTrue(matches('/home/michael/keep.tmp7'))
+        self.assertTrue(matches('/home/michael/build'))
+        self.assertFalse(matches('/home/michael/build/'))
+        self.assertFalse(matches('/home/michael/a.tmp300'))
+        for path in ['/home/michael/a.tmp5', '/home/michael/build/x',
+                     '/home/michael/dir/keep.tmp7', '/home/michael/x']:
+            self.assertEqual(
+                matches(path), handle_negation(path, matches.rules)
+            )
+
+    def test_last_matching_rule_wins_across_alternations(self):
+        # More rules with regexes than fit into one alternation.
+        lines = []
+        for i in range(250):
+            lines += ['src/**/x%d*' % (i % 10), '!src/**/x%d?' % (i % 7)]
+        matches = parse_gitignore_str('\n'.join(lines), base_dir='/home/michael')
+        for name in ['x1', 'x12', 'x1a', 'x55', 'x6', 'y']:
+            path = '/home/michael/src/a/b/' + name
+            check = matches.check(path)
+            self.assertEqual(
+                check.ignored, handle_negation(path, matches.rules)
+            )
+            self.assertIs(check.rule, next(
+                (rule for rule in reversed(matches.rules) if rule.match(path)),
+                None
+            ))
+
+    def test_match_relative(self):
+        matches = parse_gitignore_str(
+            '/build\n*.pyc\ndata/**\n!data/**/', base_dir='/home/michael'
+        )
+        for rel_path in ['build', 'build/x', 'src/build', 'a/b.pyc', 'b.py',
+                         'data/x', 'data/x/', 'data/']:
+            self.assertEqual(
+                matches.match_relative(rel_path),
+                matches('/home/michael/' + rel_path),
+                rel_path
+            )
+
+    def test_match_many(self):
+        matches = parse_gitignore_str(
+            '*.pyc\n!keep.pyc\ndata/**\n!data/**/', base_dir='/home/michael'
+        )
+        paths = [
+            '/home/michael', '/home/michael/a.pyc', '/home/michael/keep.pyc',
+            '/home/michael/src/a.pyc', '/home/michael/src/a.py',
+            Path('/home/michael/data/x'), '/home/michael/data/x/',
+            '/home/michael/../michael/b.pyc', '/home/michael/data/',
+        ]
+        expected = [matches(path) for path in paths]
+        self.assertEqual(list(matches.match_many(iter(paths))), expected)
+        self.assertEqual(
+            list(matches.filter(path for path in paths)),
+            [path for path, ignored in zip(paths, expected) if not ignored]
+        )
+        self.assertEqual(
+            list(matches.filter(paths, ignored=True)),
+            [path for path, ignored in zip(paths, expected) if ignored]
+        )
+        with self.assertRaises(ValueError):
+            list(matches.match_many(['/home/other/a.pyc']))
+
+    def test_dir_entries_and_bytes(self):
+        with TemporaryDirectory() as project_dir:
+            for name in ['a.pyc', 'a.py', 'build/', 'data/', 'keep/']:
+                path = Path(project_dir, name)
+                if name.endswith('/'):
+                    path.mkdir()
+                else:
+                    path.touch()
+            matches = parse_gitignore_str(
+                '*.pyc\nbuild\n!build\ndata\nkeep\n!keep/',
+                base_dir=project_dir
+            )
+            with scandir(project_dir) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            expected = [False, True, False, True, False]
+            self.assertEqual([matches(entry) for entry in entries], expected)
+            self.assertEqual(list(matches.match_many(entries)), expected)
+            self.assertEqual([matches.check(entry).path for entry in entries],
+                             entries)
+            with scandir(fsencode(project_dir)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            self.assertEqual([matches(entry) for entry in entries], expected)
+            paths = [fsencode(entry.path) for entry in entries]
+            self.assertEqual(list(matches.match_many(paths)),
+                             [False, True, False, True, True])
+            # A directory entry is matched like its path with or without a
+            # trailing slash, except by directory-only negations.
+            self.assertFalse(matches(entries[2].path))
+            self.assertFalse(matches(entries[2].path + b'/'))
+            self.assertFalse(matches(paths[4] + b'/'))
+            self.assertTrue(matches(fsencode(project_dir) + b'/\xff.pyc'))
+
+    def test_walk(self):
+        with TemporaryDirectory() as project_dir:
+            for path in ['main.py', 'main.pyc', 'build/out.o', 'build/keep',
+                         'src/main.py', 'src/node_modules/lib.js',
+                         'data/01_raw/raw.csv', 'data/02/processed.csv']:
+                path = Path(project_dir, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.touch()
+            matches = parse_gitignore_str(
+                '*.pyc\nbuild/\n!build/keep\nnode_modules\n'
+                'data/**\n!data/**/\n!data/01_raw/*',
+                base_dir=project_dir
+            )
+            walked = {
+                Path(dirpath).relative_to(project_dir).as_posix():
+                    (sorted(dirnames), sorted(filenames))
+                for dirpath, dirnames, filenames in matches.walk(project_dir)
+            }
+            self.assertEqual(walked, {
+                '.': (['data', 'src'], ['main.py']),
+                'src': ([], ['main.py']),
+                'data': (['01_raw', '02'], []),
+                'data/01_raw': ([], ['raw.csv']),
+                'data/02': ([], []),
+            })
+
+    def test_walk_negation_without_slash(self):
+        with TemporaryDirectory() as project_dir:
+            for path in ['src/a.py', 'other/b.py', 'build/c.o', 'd.py']:
+                path = Path(project_dir, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.touch()
+            for gitignore, expected in [
+                ('/*\n!/src', {'.': (['src'], []), 'src': ([], ['a.py'])}),
+                ('build\n!build\nother', {
+                    '.': (['build', 'src'], ['d.py']),
+                    'build': ([], ['c.o']),
+                    'src': ([], ['a.py']),
+                }),
+            ]:
+                matches = parse_gitignore_str(gitignore, base_dir=project_dir)
+                walked = {
+                    Path(dirpath).relative_to(project_dir).as_posix():
+                        (sorted(dirnames), sorted(filenames))
+                    for dirpath, dirnames, filenames in
+                    matches.walk(project_dir)
+                }
+                self.assertEqual(walked, expected, gitignore)
+                self.assertEqual(
+                    sorted(Path(path).relative_to(project_dir).as_posix()
+                           for path in matches.scan(project_dir)),
+                    sorted(join(top, name) if top != '.' else name
+                           for top, (_, names) in expected.items()
+                           for name in names)
+                )
+
+    def test_gitignore_tree(self):
+        with TemporaryDirectory() as project_dir:
+            files = {
+                'global_ignore': '*.swp\n*.bak\n',
+                '.git/info/exclude': 'local.cfg\n',
+                '.gitignore': '*.log\n!important.log\n/out/\n',
+                'src/.gitignore': '!*.bak\ndebug.log\n!local.cfg\n',
+                'src/lib/.gitignore': '!debug.log\n',
+            }
+            for path, content in files.items():
+                path = Path(project_dir, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(content)
+            matches = parse_gitignore_tree(
+                project_dir, excludes_file=Path(project_dir, 'global_ignore')
+            )
+            for path, expected in [
+                ('a.swp', True), ('a.bak', True), ('local.cfg', True),
+                ('a.log', True), ('important.log', False), ('out', True),
+                ('src/a.bak', False), ('src/a.swp', True), ('src/a.log', True),
+                ('src/debug.log', True), ('src/important.log', False),
+                ('src/local.cfg', False), ('src/out', False),
+                ('src/lib/debug.log', False), ('src/lib/a.log', True),
+                ('src/lib/a.bak', False), ('.git/config', True),
+            ]:
+                self.assertEqual(
+                    matches(Path(project_dir, path)), expected, path
+                )
+            result = matches.check(Path(project_dir, '.git/config'))
+            self.assertTrue(result.ignored)
+            self.assertIs(result.rule, matches.git_dir_rule)
+            self.assertEqual(str(result.rule), '.git')
+            self.assertIsNone(result.rule.source)
+            result = matches.check(Path(project_dir, 'src/lib/debug.log'))
+            self.assertFalse(result.ignored)
+            self.assertEqual(result.rule.source, (
+                join(project_dir, 'src', 'lib', '.gitignore'), 1
+            ))
+            walked = [
+                Path(dirpath, name).relative_to(project_dir).as_posix()
+                for dirpath, _, filenames in matches.walk(project_dir)
+                for name in filenames
+            ]
+            self.assertEqual(sorted(walked), [
+                '.gitignore', 'global_ignore', 'src/.gitignore',
+                'src/lib/.gitignore'
+            ])
+
+    def test_gitignore_tree_in_linked_worktree(self):
+        with TemporaryDirectory() as tmp_dir:
+            files = {
+                'main/.git/info/exclude': 'local.cfg\n',
+                'main/.git/config': '[core]\n\texcludesFile = %s\n' %
+                    join(tmp_dir, 'global_ignore'),
+                'main/.git/worktrees/wt/commondir': '../..\n',
+                'global_ignore': '*.swp\n',
+                'wt/.git': 'gitdir: %s\n' %
+                    join(tmp_dir, 'main', '.git', 'worktrees', 'wt'),
+            }
+            for path, content in files.items():
+                path = Path(tmp_dir, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(content)
+            home = {'HOME': tmp_dir, 'USERPROFILE': tmp_dir,
+                    'XDG_CONFIG_HOME': tmp_dir}
+            with patch.dict('os.environ', home):
+                matches = parse_gitignore_tree(join(tmp_dir, 'wt'))
+            self.assertTrue(matches(join(tmp_dir, 'wt', 'local.cfg')))
+            self.assertTrue(matches(join(tmp_dir, 'wt', 'a.swp')))
+            self.assertFalse(matches(join(tmp_dir, 'wt', 'a.py')))
+
+    def test_gitignore_tree_excluded_directory(self):
+        with TemporaryDirectory() as project_dir:
+            Path(project_dir, 'build').mkdir()
+            Path(project_dir, '.gitignore').write_text('build/\n')
+            Path(project_dir, 'build', '.gitignore').write_text('!*.o\n')
+            matches = parse_gitignore_tree(project_dir, excludes_file=False)
+            # As git check-ignore -v build/x.o reports .gitignore:1:build/
+            result = matches.check(join(project_dir, 'build', 'x.o'))
+            self.assertTrue(result.ignored)
+            self.assertEqual(str(result.rule), 'build/')
+            self.assertEqual(
+                result.rule.source, (join(project_dir, '.gitignore'), 1)
+            )
+            self.assertTrue(matches(join(project_dir, 'build', 'sub', 'y.o')))
+            self.assertTrue(matches(join(project_dir, 'build')))
+
+    def test_gitignore_tree_whitelist(self):
+        files = ['.gitignore', 'src/a.py', 'src/lib/b.py', 'src/c.pyc',
+                 'other/d.py', 'e.py', 'build/f.o', 'build/keep/g.o']
+        # As reported by git ls-files --others --ignored --exclude-standard.
+        expected = ['build/f.o', 'e.py', 'other/d.py', 'src/c.pyc']
+        with TemporaryDirectory() as project_dir:
+            for name in files:
+                path = Path(project_dir, name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.touch()
+            Path(project_dir, '.gitignore').write_text(
+                '/*\n!/src\n!.gitignore\n!/build\n/build/*\n!/build/keep\n'
+                '*.pyc\n'
+            )
+            for engine in [None, 'automaton']:
+                matches = parse_gitignore_tree(
+                    project_dir, excludes_file=False, engine=engine
+                )
+                result = matches.check(join(project_dir, 'src', 'a.py'))
+                self.assertFalse(result.ignored)
+                self.assertIsNone(result.rule)
+                self.assertEqual(
+                    sorted(name for name in files
+                           if matches(join(project_dir, name))),
+                    expected
+                )
+                stack, _ = matches._stack('src')
+                self.assertEqual(stack[-1]._engine,
+                                 engine or IgnoreRuleSet.default_engine)
+            try:
+                subprocess.run(['git', 'init', '-q', project_dir], check=True)
+                output = subprocess.run(
+                    ['git', '-c', 'core.excludesFile=', 'ls-files', '--others',
+                     '--ignored', '--exclude-standard'],
+                    cwd=project_dir, stdout=subprocess.PIPE, check=True
+                ).stdout
+            except (OSError, subprocess.CalledProcessError):
+                return
+            self.assertEqual(sorted(output.decode().splitlines()), expected)
+
+    def test_scan(self):
+        with TemporaryDirectory() as project_dir:
+            for i in range(30):
+                for path in ['f%d.py' % i, 'f%d.pyc' % i, 'build/f%d.o' % i,
+                             'sub/f.py', 'sub/sub/f.pyc', 'sub/node_modules/x']:
+                    path = Path(project_dir, 'd%d' % i, path)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.touch()
+            matches = parse_gitignore_str(
+                '*.pyc\nbuild/\nnode_modules', base_dir=project_dir
+            )
+            walked = [
+                join(dirpath, name)
+                for dirpath, _, filenames in matches.walk(project_dir)
+                for name in filenames
+            ]
+            self.assertEqual(len(walked), 60)
+            for processes in (False, True):
+                scanned = list(matches.scan(
+                    project_dir, workers=2, processes=processes, ordered=True
+                ))
+                self.assertEqual(scanned, walked)
+                self.assertEqual(
+                    sorted(matches.scan(project_dir, processes=processes)),
+                    sorted(walked)
+                )
+
+    def test_literal_patterns_agree_with_regexes(self):
+        matches = parse_gitignore_str(
+            'node_modules/\n*.log\n.DS_Store\n/docs/build\n/dist/\n'
+            '!keep.log\n!/dist/keep\n*.tar.gz\n!important/\nsrc/gen\n'
+            'build\n!*.py\ndist\n',
+            base_dir='/home/michael'
+        )
+        for rel_path in [
+            'node_modules', 'a/node_modules/b.js', 'node_modules_x',
+            'x.log', 'a/b/keep.log', 'x.logs', '.log', 'a.tar.gz',
+            'a/.DS_Store', 'docs/build', 'docs/build/x', 'a/docs/build',
+            'dist', 'dist/keep', 'dist/x/keep', 'important/x.log',
+            'src/gen', 'src/gen/x', 'a/src/gen', 'a/build', 'build/x',
+            'build.py', 'dist/', 'important/', 'x.log\n',
+        ]:
+            path = '/home/michael/' + rel_path
+            self.assertEqual(
+                matches(path), handle_negation(path, matches.rules), rel_path
+            )
+
+    def test_optimize_rules(self):
+        matches = parse_gitignore_str(
+            '!leading\n*.pyc\nbuild/main.pyc\n/docs/build/\nnode_modules\n'
+            '*.pyc\nbuild/\nnode_modules/\n', base_dir='/home/michael'
+        )
+        optimized = optimize_rules(matches.rules)
+        # Without negations, the literal rules go last.
+        self.assertEqual([str(rule) for rule in optimized],
+                         ['*.pyc', 'build/', 'node_modules/'])
+        stats = [
+            RuleStats(rule, 10, hits, 0.0)
+            for rule, hits in zip(optimized, [5, 0, 1])
+        ]
+        self.assertEqual(
+            [str(rule) for rule in optimize_rules(optimized, stats)],
+            ['build/', 'node_modules/', '*.pyc']
+        )
+        # Negations keep the order.
+        matches = parse_gitignore_str(
+            '*.log\nbuild/\n!keep.log\n*.log', base_dir='/home/michael'
+        )
+        self.assertEqual([str(rule) for rule in optimize_rules(matches.rules)],
+                         ['build/', '!keep.log', '*.log'])
+
+    def test_optimized_rules_agree(self):
+        rnd = Random(0)
+        names = ['a', 'b', 'x.py', 'x.pyc', 'build', 'lib.so']
+        patterns = [
+            'a', 'b/', '*.pyc', '*.py', '/a/b', '/a/', 'build/', 'x.pyc',
+            'a/x.pyc', '/build/x.py', 'b/**/x.py', '**/lib.*', 'a/*',
+            '/build', '*.so', 'x.*', '[ab]', 'b/x.pyc',
+        ]
+        paths = [
+            '/home/michael/' + '/'.join(
+                rnd.choice(names) for _ in range(rnd.randint(1, 4))
+            ) + rnd.choice(['', '/'])
+            for _ in range(300)
+        ]
+        for _ in range(200):
+            lines = [
+                rnd.choice(['', '', '!']) + rnd.choice(patterns)
+                for _ in range(rnd.randint(1, 12))
+            ]
+            matches = parse_gitignore_str(
+                '\n'.join(lines), base_dir='/home/michael'
+            )
+            optimized = IgnoreRuleSet(optimize_rules(matches.rules))
+            for path in paths:
+                self.assertEqual(
+                    matches(path), optimized(path), (lines, path)
+                )
+
+    def test_automaton_engine_agrees(self):
+        rnd = Random(1)
+        names = ['a', 'b', 'ab', 'x.py', 'x.pyc', '.c', '']
+        parts = ['a', 'b', '*', '**', '?', 'a*', '*.py', '*.py[cod]', '[ab]',
+                 '[!a]', '[a-c]', 'x.*', '***', 'a**', '\\*']
+        paths = [
+            '/'.join(rnd.choice(names) for _ in range(rnd.randint(1, 5))) +
+            rnd.choice(['', '', '/'])
+            for _ in range(200)
+        ]
+        for _ in range(150):
+            lines = [
+                rnd.choice(['', '', '!']) + rnd.choice(['', '/', '**/']) +
+                '/'.join(rnd.choice(parts) for _ in range(rnd.randint(1, 3))) +
+                rnd.choice(['', '', '/'])
+                for _ in range(rnd.randint(1, 6))
+            ]
+            try:
+                rules = list(iter_gitignore_rules(lines, '/home/michael'))
+            except IndexError:
+                # Some of the generated patterns, such as "**", can't be
+                # parsed.
+                continue
+            automaton = IgnoreRuleSet(rules, engine='automaton')
+            for path in paths:
+                path = '/home/michael/' + path
+                self.assertEqual(
+                    automaton(path), handle_negation(path, rules),
+                    (lines, path)
+                )
+
+    def test_automaton_glob_index(self):
+        lines = ['*', '*.py', '*.tar.gz', 'lib*', 'lib*.so', 'a?c*.so',
+                 '*[0-9]', '?', 'x[ab]y*z', 'a]b*', 'q[r', '*.py[cod]',
+                 '!*.pyc', 'f*o*o', '!lib?', 'src/*_test.py', 'src/t*']
+        names = ['a.py', 'a.pyc', 'a.tar.gz', 'lib', 'libx', 'libx.so',
+                 'abc.so', 'axcd.so', 'v1', 'x', 'xy', 'xayz', 'a]bc',
+                 'q[r', 'qr', 'foo', 'fxoyo', 'fo', 'lib1', 'x_test.py',
+                 'test.py', 'tx']
+        for i in range(len(lines)):
+            rules = list(iter_gitignore_rules(lines[i:], '/home/michael'))
+            automaton = IgnoreRuleSet(rules, engine='automaton')
+            for name in names:
+                for path in [name, 'src/' + name, 'a/src/' + name]:
+                    path = '/home/michael/' + path
+                    self.assertEqual(
+                        automaton(path), handle_negation(path, rules),
+                        (lines[i:], path)
+                    )
+
+    def test_automaton_trailing_slash(self):
+        rules = list(iter_gitignore_rules([
+            'build/', '!build/keep/', '!*.o', 'logs/**', '!logs/**/',
+            '!x[!a]/', 'out/'
+        ], '/home/michael'))
+        automaton = IgnoreRuleSet(rules, engine='automaton')
+        paths = ['build/', 'build/keep/', 'build/keep/a/', 'a.o/', 'a.o',
+                 'logs/', 'logs/a/', 'logs/a', 'xb/', 'out/', 'out/xb/']
+        # Paths with a trailing slash are not evaluated rule by rule.
+        with patch.object(gitignore_parser._RuleGroup, '_last_match_slow',
+                          side_effect=AssertionError):
+            for path in paths:
+                path = '/home/michael/' + path
+                self.assertEqual(
+                    automaton(path), handle_negation(path, rules), path
+                )
+
+    def test_classify_paths(self):
+        matches = parse_gitignore_str(
+            '*.pyc\nbuild/\n!keep.pyc', base_dir='/home/michael'
+        )
+        names = [b'a.py', b'a.pyc', b'build/x', b'keep.pyc', b'\xff.pyc']
+        paths = [b'/home/michael/' + name for name in names * 5]
+        ignored = [path for path in paths if matches(path)]
+        unignored = [path for path in paths if not matches(path)]
+        for separator in [b'\n', b'\0']:
+            # Without a final separator, and with empty lines.
+            data = separator.join(paths[:3] + [b''] + paths[3:])
+            for kwargs in [{}, dict(workers=2, chunk_size=2)]:
+                out_file = BytesIO()
+                count = classify_paths(
+                    matches, BytesIO(data), out_file, separator, **kwargs
+                )
+                self.assertEqual(count, len(ignored))
+                self.assertEqual(
+                    out_file.getvalue(),
+                    b''.join(path + separator for path in ignored)
+                )
+                out_file = BytesIO()
+                classify_paths(
+                    matches, BytesIO(data), out_file, separator,
+                    ignored=False, **kwargs
+                )
+                self.assertEqual(out_file.getvalue().split(separator)[:-1],
+                                 unignored)
+
+    def test_classify_paths_outside_base_dir(self):
+        matches = parse_gitignore_str('*.pyc', base_dir='/home/michael')
+        paths = [b'/home/michael/a.pyc', b'/tmp/b.pyc', b'/home/michael/c.py']
+        for kwargs in [{}, dict(workers=2, chunk_size=1)]:
+            errors = []
+            out_file = BytesIO()
+            classify_paths(
+                matches, BytesIO(b'\n'.join(paths)), out_file,
+                on_error=lambda path, message: errors.append(path), **kwargs
+            )
+            self.assertEqual(out_file.getvalue(), b'/home/michael/a.pyc\n')
+            self.assertEqual(errors, [b'/tmp/b.pyc'])
+            out_file = BytesIO()
+            classify_paths(
+                matches, BytesIO(b'\n'.join(paths)), out_file, ignored=False,
+                **kwargs
+            )
+            self.assertEqual(out_file.getvalue(),
+                             b'/tmp/b.pyc\n/home/michael/c.py\n')
+
+    def test_command_line(self):
+        with TemporaryDirectory() as project_dir:
+            gitignore = join(project_dir, '.gitignore')
+            with open(gitignore, 'w') as f:
+                f.write('*.pyc\n')
+            paths = [join(project_dir, name) for name in ['a.py', 'a.pyc']]
+            result = subprocess.run(
+                [sys.executable, '-m', 'gitignore_parser', '-z', gitignore],
+                input=b'\0'.join(map(fsencode, paths)), stdout=subprocess.PIPE,
+                check=True, cwd=dirname(gitignore_parser.__file__)
+            )
+            self.assertEqual(result.stdout, fsencode(paths[1]) + b'\0')
+            result = subprocess.run(
+                [sys.executable, '-m', 'gitignore_parser', '--unignored',
+                 '--engine', 'automaton', project_dir],
+                input=b'\n'.join(map(fsencode, paths)), stdout=subprocess.PIPE,
+                check=True, cwd=dirname(gitignore_parser.__file__)
+            )
+            self.assertEqual(result.stdout, fsencode(paths[0]) + b'\n')
+
+    def test_command_line_errors(self):
+        with TemporaryDirectory() as project_dir:
+            gitignore = join(project_dir, '.gitignore')
+            with open(gitignore, 'w') as f:
+                f.write('*.pyc\n')
+            paths = [join(project_dir, 'a.pyc'), '/outside/b.pyc',
+                     join(project_dir, 'c.pyc')]
+            result = subprocess.run(
+                [sys.executable, '-m', 'gitignore_parser', gitignore],
+                input='\n'.join(paths).encode(), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, check=True,
+                cwd=dirname(gitignore_parser.__file__)
+            )
+            self.assertEqual(result.stdout.decode().splitlines(),
+                             [paths[0], paths[2]])
+            self.assertIn('/outside/b.pyc', result.stderr.decode())
+            # The reader of the output exits early, like head does.
+            paths_file = join(project_dir, 'paths')
+            with open(paths_file, 'w') as f:
+                f.write('\n'.join(paths[:1] * 100000))
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'gitignore_parser', '-j', '1',
+                 gitignore, paths_file],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                cwd=dirname(gitignore_parser.__file__)
+            )
+            self.assertEqual(process.stdout.readline().decode(),
+                             paths[0] + '\n')
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            self.assertEqual(process.wait(), 1)
+            self.assertEqual(stderr, b'')
+
+    def test_result_cache(self):
+        matches = parse_gitignore_str(
+            '*.pyc\nbuild\n!build/keep', base_dir='/home/michael',
+            cache_size=2
+        )
+        self.assertTrue(matches('/home/michael/a.pyc'))
+        self.assertTrue(matches('/home/michael/a.pyc'))
+        self.assertFalse(matches('/home/michael/build/keep'))
+        self.assertFalse(matches('/home/michael/a.py'))
+        self.assertTrue(matches('/home/michael/a.pyc'))
+        self.assertEqual(tuple(matches.cache_info()), (1, 4, 2, 2))
+        matches.rules = matches.rules[1:]
+        self.assertEqual(tuple(matches.cache_info()), (0, 0, 2, 0))
+        self.assertFalse(matches('/home/michael/a.pyc'))
+
+    def test_directory_cache(self):
+        matches = parse_gitignore_str(
+            'build\n!build/keep\n/data/\n!/data/**/', base_dir='/home/michael',
+            cache_size=100, exclude_below_excluded_dirs=True
+        )
+        # Unlike without exclude_below_excluded_dirs, as in git, nothing
+        # below an excluded directory can be re-included.
+        self.assertTrue(matches('/home/michael/build/keep'))
+        self.assertTrue(matches('/home/michael/build/x/y'))
+        self.assertTrue(matches('/home/michael/src/build/x'))
+        self.assertFalse(matches('/home/michael/src/x'))
+        self.assertTrue(matches('/home/michael/data/x/y'))
+        self.assertEqual(matches.cache_info().misses, 5)
+        matches.rules = [rule_from_pattern('src/', matches.rules[0].base_path)]
+        self.assertFalse(matches('/home/michael/build/keep'))
+        self.assertTrue(matches('/home/michael/src/x'))
+
+    def test_exclude_below_excluded_dirs(self):
+        paths = ['/home/michael/src/a.py', '/home/michael/x/a.py',
+                 '/home/michael/build/keep', '/home/michael/build/x']
+        for kwargs in [{}, dict(cache_size=10)]:
+            # The result cache alone doesn't change any verdicts.
+            matches = parse_gitignore_str(
+                '/*\n!/src\nbuild\n!build/keep', base_dir='/home/michael',
+                **kwargs
+            )
+            self.assertEqual([matches(path) for path in paths],
+                             [False, False, False, False])
+            matches = parse_gitignore_str(
+                '/*\n!/src\nbuild\n!build/keep', base_dir='/home/michael',
+                exclude_below_excluded_dirs=True, **kwargs
+            )
+            expected = [False, True, True, True]
+            self.assertEqual([matches(path) for path in paths], expected)
+            self.assertEqual(list(matches.match_many(paths)), expected)
+
+    def test_check(self):
+        matches = parse_gitignore_str(
+            '*.pyc\nbuild/\n!build/keep.pyc', base_dir='/home/michael'
+        )
+        paths = [
+            '/home/michael/a.pyc', '/home/michael/build/keep.pyc',
+            '/home/michael/build/x', '/home/michael/a.py'
+        ]
+        results = list(matches.check_many(paths))
+        self.assertEqual(
+            [(r.path, str(r.rule), r.ignored) for r in results],
+            [(paths[0], '*.pyc', True), (paths[1], '!build/keep.pyc', False),
+             (paths[2], 'build/', True), (paths[3], 'None', False)]
+        )
+        self.assertEqual(results[1].rule.source[1], 3)
+        self.assertEqual([matches.check(path) for path in paths], results)
+        cached = parse_gitignore_str(
+            'build\n!build/keep.pyc', base_dir='/home/michael',
+            cache_size=10, exclude_below_excluded_dirs=True
+        )
+        result = cached.check('/home/michael/build/keep.pyc')
+        self.assertTrue(result.ignored)
+        self.assertEqual(str(result.rule), 'build')
+
+    def test_rule_stats(self):
+        hits = []
+        matches = parse_gitignore_str(
+            '*.pyc\nbuild/\n!build/keep\n/unused', base_dir='/home/michael',
+            on_rule_hit=lambda rule, rel_path, seconds:
+                hits.append((str(rule), rel_path))
+        )
+        self.assertTrue(matches('/home/michael/a.pyc'))
+        self.assertTrue(matches('/home/michael/build/a.pyc'))
+        self.assertFalse(matches('/home/michael/build/keep'))
+        self.assertFalse(matches('/home/michael/a.py'))
+        self.assertEqual(hits, [
+            ('*.pyc', 'a.pyc'), ('build/', 'build/a.pyc'),
+            ('!build/keep', 'build/keep')
+        ])
+        stats = matches.rule_stats()
+        self.assertEqual(
+            [(str(s.rule), s.evaluations, s.hits) for s in stats],
+            [('*.pyc', 2, 1), ('build/', 3, 1), ('!build/keep', 4, 1),
+             ('/unused', 4, 0)]
+        )
+        self.assertEqual(stats[3].rule.source[1], 4)
+        self.assertTrue(all(s.time >= 0 for s in stats))
+        matches.clear_stats()
+        self.assertEqual(matches.rule_stats()[0].evaluations, 0)
+        self.assertIsNone(parse_gitignore_str('*.pyc', '/').rule_stats())
+
+    def test_reload_while_matching(self):
+        with TemporaryDirectory() as project_dir:
+            gitignore = Path(project_dir, '.gitignore')
+            versions = [
+                ''.join('dir%d/\n' % i for i in range(7)) + '*.pyc\n',
+                '!*.pyc\n',
+            ]
+            gitignore.write_text(versions[0])
+            matches = IgnoreFile(str(gitignore), cache_size=10)
+            path = join(project_dir, 'x.pyc')
+            errors = []
+            stop = Event()
+
+            def query():
+                while not stop.is_set():
+                    try:
+                        matches(path)
+                        matches.check(path)
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            thread = Thread(target=query)
+            thread.start()
+            try:
+                for i in range(300):
+                    gitignore.write_text(versions[i % 2])
+                    matches.reload()
+            finally:
+                stop.set()
+                thread.join()
+            self.assertEqual(errors, [])
+            # No stale result was put back into the cache.
+            self.assertEqual(matches(path), i % 2 == 0)
+
+    def test_reload(self):
+        with TemporaryDirectory() as project_dir:
+            gitignore = Path(project_dir, '.gitignore')
+            gitignore.write_text('*.pyc\n# comment\nbuild/\n!keep.pyc\n')
+            matches = IgnoreFile(str(gitignore), cache_size=10)
+            pyc, keep, log, build = [
+                join(project_dir, name)
+                for name in ('a.pyc', 'keep.pyc', 'a.log', 'build')
+            ]
+            self.assertEqual(
+                [matches(path) for path in (pyc, keep, log, build)],
+                [True, False, False, True]
+            )
+            self.assertFalse(matches.reload())
+            old_rules = matches.rules
+
+            gitignore.write_text('*.pyc\n*.log\nbuild/\n!keep.pyc\n')
+            # Make sure the modification time changes.
+            utime(gitignore, ns=(0, 0))
+            self.assertTrue(matches.reload())
+            self.assertIs(matches.rules[0], old_rules[0])
+            self.assertEqual(matches.rules[2].regex, old_rules[1].regex)
+            self.assertEqual(matches.rules[2].source, (str(gitignore), 3))
+            # Only the result for the path matching *.log was dropped.
+            self.assertEqual(matches.cache_info().currsize, 3)
+            self.assertEqual(
+                [matches(path) for path in (pyc, keep, log, build)],
+                [True, False, True, True]
+            )
+
+            changed = []
+            watcher = IgnoreFileWatcher([matches], callback=changed.append)
+            self.assertEqual(watcher.poll(), [])
+            gitignore.write_text('*.log\n')
+            utime(gitignore, ns=(1, 1))
+            self.assertEqual(watcher.poll(), [matches])
+            self.assertEqual(changed, [matches])
+            self.assertFalse(matches(pyc))
+            gitignore.unlink()
+            watcher.poll()
+            self.assertFalse(matches(log))
+
+    def test_compiled_regex(self):
+        rule = rule_from_pattern('/a/*.pyc', base_path=Path('/home/michael'))
+        other = rule_from_pattern('/a/*.pyc', base_path=Path('/home/other'))
+        self.assertIs(rule.compiled, other.compiled)
+        self.assertEqual(rule.compiled.pattern, rule.regex)
+        self.assertEqual(rule._fields, (
+            'pattern', 'regex', 'negation', 'directory_only', 'anchored',
+            'base_path', 'source'
+        ))
+        self.assertTrue(rule.match('/home/michael/a/b.pyc'))
+        self.assertFalse(rule.match('/home/michael/b/a/b.pyc'))
+
+    def test_compiled_regex_cache_is_bounded(self):
+        for i in range(200):
+            matches = parse_gitignore_str(
+                '\n'.join('repo%d/*.x%d' % (i, j) for j in range(50)),
+                base_dir='/home/michael'
+            )
+            for rule in matches.rules:
+                rule.match('/home/michael/repo%d/a.x1' % i)
+            self.assertTrue(matches('/home/michael/repo%d/a.x1' % i))
+        self.assertLessEqual(
+            gitignore_parser._compile_regex.cache_info().currsize,
+            gitignore_parser._REGEX_CACHE_SIZE
+        )
+
+    def test_rules_keep_compiled_regex(self):
+        rules = list(iter_gitignore_rules(
+            ['repo%d/*.x' % i
+             for i in range(gitignore_parser._REGEX_CACHE_SIZE + 100)],
+            '/home/michael'
+        ))
+        compiled = [rule.compiled for rule in rules]
+        # None was evicted and compiled again.
+        self.assertTrue(all(
+            rule.compiled is pattern for rule, pattern in zip(rules, compiled)
+        ))
+        self.assertTrue(rules[0].match('/home/michael/repo0/a.x'))
+        copy = pickle.loads(pickle.dumps(rules[0]))
+        self.assertEqual(copy, rules[0])
+        self.assertNotIn('compiled', vars(copy.regex))
+
+    def test_rule_cache(self):
+        with TemporaryDirectory() as project_dir:
+            gitignore = Path(project_dir, '.gitignore')
+            gitignore.write_text('*.pyc\n\n/build/\n!keep.pyc\n')
+            cache_dir = join(project_dir, 'cache')
+            matches = parse_gitignore(str(gitignore), cache_dir=cache_dir)
+            with patch('gitignore_parser._translations', {}), \
+                    patch('gitignore_parser._translate_pattern_uncached') \
+                    as translate:
+                cached = parse_gitignore(str(gitignore), cache_dir=cache_dir)
+                self.assertEqual(cached.rules, matches.rules)
+                self.assertTrue(cached(join(project_dir, 'a.pyc')))
+                self.assertFalse(cached(join(project_dir, 'keep.pyc')))
+                self.assertTrue(cached(join(project_dir, 'build')))
+                translate.assert_not_called()
+            gitignore.write_text('*.log\n')
+            changed = parse_gitignore(str(gitignore), cache_dir=cache_dir)
+            self.assertFalse(changed(join(project_dir, 'a.pyc')))
+            self.assertTrue(changed(join(project_dir, 'a.log')))
+
+    def test_rule_sets_share_memory(self):
+        gitignore = '*.pyc\nnode_modules/\nsrc/**/gen\n!keep.pyc\n'
+        first = parse_gitignore_str(gitignore, base_dir='/home/michael/a')
+        second = parse_gitignore_str(gitignore, base_dir='/home/michael/b')
+        self.assertIs(first.rules[0].pattern, second.rules[0].pattern)
+        self.assertIs(first.rules[2].regex, second.rules[2].regex)
+        (first_group,), (second_group,) = \
+            first._state.groups.values(), second._state.groups.values()
+        self.assertIs(first_group.tables, second_group.tables)
+        self.assertFalse(hasattr(first.rules[0], '__dict__'))
+        self.assertTrue(first('/home/michael/a/src/x/gen'))
+        self.assertFalse(second('/home/michael/b/keep.pyc'))
+
+    def test_parse_gitignore_lines(self):
+        errors, progress = [], []
+        matches = parse_gitignore_lines(
+            BytesIO(b'*.pyc\r\n!\r\nd\xc3\xa9j\xe0/\r\n# comment\n'),
+            base_dir='/home/michael',
+            on_error=lambda source, line, e: errors.append((source, line)),
+            on_progress=lambda *args: progress.append(args)
+        )
+        self.assertEqual(errors, [((join('/home/michael', '.gitignore'), 2), '!')])
+        self.assertEqual(progress, [(4, 2)])
+        self.assertTrue(matches('/home/michael/a.pyc'))
+        self.assertTrue(matches('/home/michael/d\xe9j\udce0/x'))
+        with self.assertRaises(IndexError):
+            parse_gitignore_lines(['*.pyc', '!'], base_dir='/home/michael')
+
+    def test_iter_gitignore_rules_is_lazy(self):
+        consumed = []
+        def lines():
+            for i in range(100000):
+                consumed.append(i)
+                yield 'file%d\n' % i
+        rules = iter_gitignore_rules(lines(), base_dir='/home/michael')
+        rule = next(rules)
+        self.assertEqual(rule.pattern, 'file0')
+        self.assertEqual(rule.source, (join('/home/michael', '.gitignore'), 1))
+        self.assertEqual(consumed, [0])
+
+    def test_async(self):
+        with TemporaryDirectory() as project_dir:
+            for i in range(10):
+                for path in ['a.py', 'a.pyc', 'build/a.py', 'sub/b.py']:
+                    path = Path(project_dir, 'd%d' % i, path)
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    path.touch()
+            matches = parse_gitignore_str(
+                '*.pyc\nbuild/', base_dir=project_dir
+            )
+            walked = sorted(
+                join(dirpath, name)
+                for dirpath, _, filenames in matches.walk(project_dir)
+                for name in filenames
+            )
+
+            async def collect():
+                return [
+                    path async for path in
+                    matches.aiter_unignored(project_dir, max_pending=2)
+                ]
+            self.assertEqual(sorted(run(collect())), walked)
+
+            async def first():
+                async for path in matches.aiter_unignored(project_dir):
+                    return path
+            self.assertIn(run(first()), walked)
+
+            async def paths():
+                for i in range(5):
+                    yield '%s/%d.pyc' % (project_dir, i)
+                    yield '%s/%d.py' % (project_dir, i)
+
+            async def collect_filtered():
+                return [
+                    path async for path in
+                    matches.afilter(paths(), chunk_size=3)
+                ]
+            self.assertEqual(
+                run(collect_filtered()),
+                ['%s/%d.py' % (project_dir, i) for i in range(5)]
+            )
+
+
+class AutomatonEngineTest(Test):
+    """Runs all of the tests above with the 'automaton' engine."""
+    def setUp(self):
+        patcher = patch.object(IgnoreRuleSet, 'default_engine', 'automaton')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
 if __name__ == '__main__':
     main()